@@ -1,430 +1,4111 @@
-import asyncio
-import psutil
-import time
-import json
-import os
-import smtplib, ssl
-from email.message import EmailMessage
-
-
-from pysnmp.hlapi.v3arch.asyncio import *
-from pysnmp.proto.api import v2c
-from pysnmp.entity import config
-from pysnmp.carrier.asyncio.dgram import udp
-from pysnmp.entity.rfc3413 import cmdrsp, ntforg, context
-
-
-# --------------------------------------------------------------------
-# CONFIGURACIÓN EMAIL (Gmail)
-# --------------------------------------------------------------------
-ENABLE_EMAIL = True
-GMAIL_USER = "aranchaaraguascalvojaca@gmail.com"
-GMAIL_APP_PASS = "aige rnxt emvh ruuq"
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 465
-
-
-
-
-def send_email_gmail(to_addr, subject, body):
-    """Envía un correo HTML bonito con los datos del evento."""
-    try:
-        msg = EmailMessage()
-        msg["From"] = GMAIL_USER
-        msg["To"] = to_addr
-        msg["Subject"] = subject
-
-
-        html_content = f"""
-        <html>
-        <body style='font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px;'>
-            <div style='max-width: 600px; background: white; border-radius: 10px;
-                        box-shadow: 0 0 10px rgba(0,0,0,0.1); padding: 20px;'>
-                <h2 style='color: #d9534f;'>⚠️ Alerta SNMP - Umbral de CPU Superado</h2>
-                <p>Estimado administrador,</p>
-                <p>El agente SNMP ha detectado que el uso de CPU ha excedido el umbral configurado.</p>
-                <table style='width: 100%; border-collapse: collapse;'>
-                    <tr><td><strong>Uso de CPU:</strong></td><td>{body.split('|')[0]}</td></tr>
-                    <tr><td><strong>Umbral:</strong></td><td>{body.split('|')[1]}</td></tr>
-                    <tr><td><strong>Fecha y hora:</strong></td><td>{body.split('|')[2]}</td></tr>
-                </table>
-                <p>Por favor, revise el estado del sistema para evitar un posible sobrecalentamiento.</p>
-                <hr>
-                <p style='font-size: 12px; color: gray;'>Mensaje automático generado por el agente SNMP local.</p>
-            </div>
-        </body>
-        </html>
-        """
-
-
-        msg.set_content("Alerta SNMP: CPU superó el umbral.")
-        msg.add_alternative(html_content, subtype="html")
-
-
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
-            server.login(GMAIL_USER, GMAIL_APP_PASS)
-            server.send_message(msg)
-
-
-        print(f"[EMAIL] Correo enviado correctamente a {to_addr}")
-
-
-    except Exception as e:
-        print(f"[ERROR] Fallo al enviar correo: {e}")
-
-
-
-
-# --------------------------------------------------------------------
-# PERSISTENCIA DEL ESTADO
-# --------------------------------------------------------------------
-STATE_FILE = "mib_state.json"
-
-
-DEFAULT_STORE = {
-    "1.3.6.1.4.1.28308.1.1.0": ("DisplayString", "Admin"),
-    "1.3.6.1.4.1.28308.1.2.0": ("DisplayString", "perezarancha28@gmail.com"),
-    "1.3.6.1.4.1.28308.1.3.0": ("Integer32", 0),
-    "1.3.6.1.4.1.28308.1.4.0": ("Integer32", 20),
-    "1.3.6.1.4.1.28308.1.5.0": ("DateAndTime", ""),
-}
-
-
-
-
-def save_state(state):
-    try:
-        with open(STATE_FILE, "w") as f:
-            json.dump(state, f, indent=2)
-    except Exception as e:
-        print(f"[ERROR] No se pudo guardar mib_state.json: {e}")
-
-
-
-
-def load_state():
-    if not os.path.exists(STATE_FILE):
-        save_state(DEFAULT_STORE)
-        return DEFAULT_STORE.copy()
-    try:
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    except:
-        save_state(DEFAULT_STORE)
-        return DEFAULT_STORE.copy()
-
-
-
-
-STORE = load_state()
-
-
-# --------------------------------------------------------------------
-# MOTOR SNMP — configuración de comunidades y permisos
-# --------------------------------------------------------------------
-snmp_engine = SnmpEngine()
-snmpContext = context.SnmpContext(snmp_engine)
-
-
-# Comunidad pública (solo lectura)
-config.addV1System(snmp_engine, "public-area", "public")
-
-
-# Comunidad privada (lectura y escritura)
-config.addV1System(snmp_engine, "private-area", "private")
-
-
-# Asignar vistas de acceso por modelo de seguridad (v1 y v2c)
-for secModel in (1, 2):
-    config.addVacmUser(
-        snmp_engine,
-        secModel,
-        "public-area",
-        "noAuthNoPriv",
-        readSubTree=(1, 3, 6, 1)
-    )
-    config.addVacmUser(
-        snmp_engine,
-        secModel,
-        "private-area",
-        "noAuthNoPriv",
-        readSubTree=(1, 3, 6, 1),
-        writeSubTree=(1, 3, 6, 1)
-    )
-
-
-# Transporte UDP
-config.addTransport(
-    snmp_engine,
-    udp.DOMAIN_NAME,
-    udp.UdpTransport().openServerMode(("0.0.0.0", 1161))
-)
-
-
-
-
-
-# Configuración de destino de traps
-config.addTargetParams(snmp_engine, "v2c-params", "public-area", "noAuthNoPriv", 2)
-config.addTargetAddr(
-    snmp_engine,
-    "trap-dest-localhost",
-    udp.DOMAIN_NAME,
-    ("127.0.0.1", 162),
-    "v2c-params",
-    tagList="all-traps"
-)
-config.addNotificationTarget(snmp_engine, "public-area", "v2c-params", "all-traps", "trap")
-
-
-# --------------------------------------------------------------------
-# FUNCIONES AUXILIARES
-# --------------------------------------------------------------------
-CPU_OID = "1.3.6.1.4.1.28308.1.3.0"
-THRESH_OID = "1.3.6.1.4.1.28308.1.4.0"
-EMAIL_OID = "1.3.6.1.4.1.28308.1.2.0"
-EVENTTIME_OID = "1.3.6.1.4.1.28308.1.5.0"
-
-
-READ_ONLY_OIDS = {CPU_OID, EVENTTIME_OID}
-
-
-
-
-def to_varbind(oid: str):
-    try:
-        t, v = STORE[oid]
-        if t == "Integer32":
-            return (v2c.ObjectIdentifier(oid), v2c.Integer(int(v)))
-        elif t == "DateAndTime":
-            return (v2c.ObjectIdentifier(oid), v2c.OctetString(v.encode("utf-8")))
-        else:
-            return (v2c.ObjectIdentifier(oid), v2c.OctetString(str(v)))
-    except KeyError:
-        return (v2c.ObjectIdentifier(oid), v2c.NoSuchObject())
-
-
-
-
-def find_next_oid(oid_str: str):
-    all_oids = sorted(STORE.keys())
-    for o in all_oids:
-        if o > oid_str:
-            return o
-    return None
-
-
-
-
-# --------------------------------------------------------------------
-# HANDLERS SNMP (GET / GETNEXT / SET)
-# --------------------------------------------------------------------
-class MiniGet(cmdrsp.GetCommandResponder):
-    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
-        req = v2c.apiPDU.getVarBinds(PDU)
-        rsp = [(oid, to_varbind(str(oid))[1]) if str(oid) in STORE else (oid, v2c.NoSuchObject()) for oid, _ in req]
-        rsp_pdu = v2c.apiPDU.getResponse(PDU)
-        v2c.apiPDU.setVarBinds(rsp_pdu, rsp)
-        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-
-
-
-
-class MiniGetNext(cmdrsp.NextCommandResponder):
-    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
-        req = v2c.apiPDU.getVarBinds(PDU)
-        rsp = []
-        for oid, _ in req:
-            next_oid = find_next_oid(str(oid))
-            rsp.append(to_varbind(next_oid) if next_oid else (oid, v2c.EndOfMibView()))
-        rsp_pdu = v2c.apiPDU.getResponse(PDU)
-        v2c.apiPDU.setVarBinds(rsp_pdu, rsp)
-        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-
-
-
-
-class MiniSet(cmdrsp.SetCommandResponder):
-    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
-        # --- Detección de comunidad (bloquea SET con public) ---
-        try:
-            exec_ctx = snmpEngine.observer.getExecutionContext("rfc3412.receiveMessage:request")
-            sec_name = exec_ctx.get("securityName").prettyPrint() if exec_ctx else None
-        except Exception:
-            sec_name = None
-
-
-        if sec_name == "public-area":
-            rsp_pdu = v2c.apiPDU.getResponse(PDU)
-            v2c.apiPDU.setErrorStatus(rsp_pdu, 17)
-            v2c.apiPDU.setErrorIndex(rsp_pdu, 1)
-            v2c.apiPDU.setVarBinds(rsp_pdu, v2c.apiPDU.getVarBinds(PDU))
-            self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-            print("[DENEGADO] SET rechazado desde comunidad RO 'public'")
-            return
-
-
-        # --- Validaciones normales ---
-        req = v2c.apiPDU.getVarBinds(PDU)
-        rsp_pdu = v2c.apiPDU.getResponse(PDU)
-
-
-        for idx, (oid, val) in enumerate(req, start=1):
-            s = str(oid)
-
-
-            if s not in STORE:
-                v2c.apiPDU.setErrorStatus(rsp_pdu, 6)
-                v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
-                v2c.apiPDU.setVarBinds(rsp_pdu, req)
-                self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-                return
-
-
-            if s in READ_ONLY_OIDS:
-                v2c.apiPDU.setErrorStatus(rsp_pdu, 17)
-                v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
-                v2c.apiPDU.setVarBinds(rsp_pdu, req)
-                self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-                return
-
-
-            t, _ = STORE[s]
-            if (t == "Integer32" and not isinstance(val, v2c.Integer)) or \
-               (t == "DisplayString" and not isinstance(val, v2c.OctetString)):
-                v2c.apiPDU.setErrorStatus(rsp_pdu, 7)
-                v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
-                v2c.apiPDU.setVarBinds(rsp_pdu, req)
-                self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-                return
-
-
-            if t == "DisplayString" and len(val.prettyPrint()) > 64:
-                v2c.apiPDU.setErrorStatus(rsp_pdu, 10)
-                v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
-                v2c.apiPDU.setVarBinds(rsp_pdu, req)
-                self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-                return
-
-
-            if t == "Integer32":
-                intval = int(val)
-                if intval < 0 or intval > 100:
-                    v2c.apiPDU.setErrorStatus(rsp_pdu, 10)
-                    v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
-                    v2c.apiPDU.setVarBinds(rsp_pdu, req)
-                    self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-                    return
-
-
-        rsp_varbinds = []
-        for oid, val in req:
-            s = str(oid)
-            t, _ = STORE[s]
-            if t == "Integer32":
-                STORE[s] = (t, int(val))
-            elif t == "DisplayString":
-                STORE[s] = (t, val.prettyPrint())
-            rsp_varbinds.append(to_varbind(s))
-
-
-        save_state(STORE)
-        v2c.apiPDU.setErrorStatus(rsp_pdu, 0)
-        v2c.apiPDU.setErrorIndex(rsp_pdu, 0)
-        v2c.apiPDU.setVarBinds(rsp_pdu, rsp_varbinds)
-        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
-
-
-
-
-MiniGet(snmp_engine, snmpContext)
-MiniGetNext(snmp_engine, snmpContext)
-MiniSet(snmp_engine, snmpContext)
-
-
-# --------------------------------------------------------------------
-# MONITOR DE CPU + TRAP + EMAIL
-# --------------------------------------------------------------------
-async def cpu_monitor():
-    psutil.cpu_percent(interval=None)
-    last_over = False
-    ntfOrg = ntforg.NotificationOriginator()
-
-
-    while True:
-        await asyncio.sleep(5)
-        loop = asyncio.get_running_loop()
-        cpu = int(psutil.cpu_percent(interval=None))
-        thr = int(STORE[THRESH_OID][1])
-        email = STORE[EMAIL_OID][1]
-        over = cpu > thr
-
-
-        STORE[CPU_OID] = ("Integer32", cpu)
-        save_state(STORE)
-
-
-        if over and not last_over:
-            now = time.strftime("%Y-%m-%d,%H:%M:%S")
-            STORE[EVENTTIME_OID] = ("DateAndTime", now)
-            save_state(STORE)
-
-
-            varBinds = [
-                (v2c.ObjectIdentifier("1.3.6.1.6.3.1.1.4.1.0"), v2c.ObjectIdentifier("1.3.6.1.4.1.28308.2.1")),
-                (v2c.ObjectIdentifier(CPU_OID), v2c.Integer(cpu)),
-                (v2c.ObjectIdentifier(THRESH_OID), v2c.Integer(thr)),
-                (v2c.ObjectIdentifier(EMAIL_OID), v2c.OctetString(email)),
-                (v2c.ObjectIdentifier(EVENTTIME_OID), v2c.OctetString(now.encode("utf-8"))),
-            ]
-
-
-            try:
-                await loop.run_in_executor(None, ntfOrg.sendVarBinds, snmp_engine, "public-area", None, "trap", varBinds)
-                print(f"[TRAP] CPU={cpu}% > {thr}% - Trap enviado, eventTime={now}")
-            except Exception as e:
-                print(f"[ERROR] Fallo al enviar TRAP: {e}")
-
-
-            if ENABLE_EMAIL:
-                subject = f"Alerta SNMP: CPU {cpu}% > {thr}%"
-                body = f"{cpu}%|{thr}%|{now}"
-                try:
-                    await loop.run_in_executor(None, send_email_gmail, email, subject, body)
-                except Exception as e:
-                    print(f"[ERROR] Fallo al enviar correo: {e}")
-
-
-        last_over = over
-
-
-
-
-# --------------------------------------------------------------------
-# MAIN LOOP
-# --------------------------------------------------------------------
-def main():
-    print("Mini SNMP Agent (pysnmp 7.1.4)")
-    print("Escuchando en UDP/1161 (comunidades: public/private)")
-
-
-    loop = asyncio.get_event_loop()
-    loop.create_task(cpu_monitor())
-
-
-    try:
-        snmp_engine.transportDispatcher.jobStarted(1)
-        loop.run_forever()
-    except KeyboardInterrupt:
-        print("Cerrando agente...")
-    finally:
-        print("Agente cerrado.")
-
-
-
-
-if __name__ == "__main__":
-    main()
-
-
+import abc
+import asyncio
+import multiprocessing
+import pickle
+import psutil
+import time
+import json
+import hashlib
+import os
+import re
+import smtplib, ssl
+import signal
+import socket
+import stat
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from email.message import EmailMessage
+
+
+from pysnmp.hlapi.v3arch.asyncio import *
+from pysnmp.proto.api import v2c
+from pysnmp.entity import config
+from pysnmp.carrier.asyncio.dgram import udp, udp6
+from pysnmp.carrier.asyncio.dgram.base import DgramAsyncioProtocol
+from pysnmp.entity.rfc3413 import cmdrsp, ntforg, context
+from pysnmp.proto import error
+from pysnmp.proto.secmod import rfc2576
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.type import univ
+
+
+# --------------------------------------------------------------------
+# CONFIGURACIÓN EMAIL (Gmail)
+# --------------------------------------------------------------------
+ENABLE_EMAIL = True
+GMAIL_USER = "aranchaaraguascalvojaca@gmail.com"
+GMAIL_APP_PASS = "aige rnxt emvh ruuq"
+SMTP_SERVER = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_SECURITY = "ssl"        # "ssl" (SMTP_SSL), "starttls" o "plain" (p. ej. un smtpd local de pruebas)
+SMTP_LOGIN = True            # autenticarse con GMAIL_USER / GMAIL_APP_PASS
+SMTP_TIMEOUT = 15.0
+SMTP_KEEPALIVE = 60.0        # segundos sin enviar tras los que se comprueba la conexión (NOOP)
+SMTP_IDLE_CLOSE = 300.0      # segundos sin enviar tras los que se cierra la conexión
+EMAIL_QUEUE_SIZE = 100       # alertas pendientes como máximo; las que no caben se descartan
+EMAIL_DIGEST_WINDOW = 30.0   # las alertas que llegan en esta ventana tras un envío van en un resumen
+EMAIL_DRAIN_TIMEOUT = 20.0   # segundos para enviar lo pendiente al cerrar el agente
+
+
+
+
+_EMAIL_STYLE = """font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 20px;"""
+_EMAIL_BOX = """max-width: 600px; background: white; border-radius: 10px;
+                        box-shadow: 0 0 10px rgba(0,0,0,0.1); padding: 20px;"""
+
+
+
+
+def build_alert_email(to_addr, subject, body):
+    """Correo HTML bonito con los datos de un evento (body = "cpu|umbral|fecha")."""
+    msg = EmailMessage()
+    msg["From"] = GMAIL_USER
+    msg["To"] = to_addr
+    msg["Subject"] = subject
+
+
+    cpu, thr, when = body.split("|")[:3]
+    html_content = f"""
+        <html>
+        <body style='{_EMAIL_STYLE}'>
+            <div style='{_EMAIL_BOX}'>
+                <h2 style='color: #d9534f;'>⚠️ Alerta SNMP - Umbral de CPU Superado</h2>
+                <p>Estimado administrador,</p>
+                <p>El agente SNMP ha detectado que el uso de CPU ha excedido el umbral configurado.</p>
+                <table style='width: 100%; border-collapse: collapse;'>
+                    <tr><td><strong>Uso de CPU:</strong></td><td>{cpu}</td></tr>
+                    <tr><td><strong>Umbral:</strong></td><td>{thr}</td></tr>
+                    <tr><td><strong>Fecha y hora:</strong></td><td>{when}</td></tr>
+                </table>
+                <p>Por favor, revise el estado del sistema para evitar un posible sobrecalentamiento.</p>
+                <hr>
+                <p style='font-size: 12px; color: gray;'>Mensaje automático generado por el agente SNMP local.</p>
+            </div>
+        </body>
+        </html>
+        """
+
+
+    msg.set_content("Alerta SNMP: CPU superó el umbral.")
+    msg.add_alternative(html_content, subtype="html")
+    return msg
+
+
+
+
+def build_digest_email(to_addr, alerts):
+    """Un único correo con varias alertas [(subject, body), ...] ocurridas en la misma ventana."""
+    msg = EmailMessage()
+    msg["From"] = GMAIL_USER
+    msg["To"] = to_addr
+    msg["Subject"] = f"Alerta SNMP: resumen de {len(alerts)} alertas"
+
+
+    rows = []
+    for subject, body in alerts:
+        cpu, thr, when = body.split("|")[:3]
+        rows.append(f"<tr><td>{when}</td><td>{cpu}</td><td>{thr}</td><td>{subject}</td></tr>")
+    html_content = f"""
+        <html>
+        <body style='{_EMAIL_STYLE}'>
+            <div style='{_EMAIL_BOX}'>
+                <h2 style='color: #d9534f;'>⚠️ Alertas SNMP - Resumen</h2>
+                <p>Estimado administrador,</p>
+                <p>El agente SNMP ha generado {len(alerts)} alertas en poco tiempo:</p>
+                <table style='width: 100%; border-collapse: collapse;'>
+                    <tr><th>Fecha y hora</th><th>Uso de CPU</th><th>Umbral</th><th>Alerta</th></tr>
+                    {"".join(rows)}
+                </table>
+                <hr>
+                <p style='font-size: 12px; color: gray;'>Mensaje automático generado por el agente SNMP local.</p>
+            </div>
+        </body>
+        </html>
+        """
+
+
+    msg.set_content("\n".join(f"{body.split('|')[2]}  {subject}" for subject, body in alerts))
+    msg.add_alternative(html_content, subtype="html")
+    return msg
+
+
+
+
+class _TrackedSMTP:
+    """Anota si el envío en curso ha llegado a DATA (a partir de ahí no se reintenta)."""
+
+    data_started = False
+
+
+    def data(self, msg):
+        self.data_started = True
+        return super().data(msg)
+
+
+
+
+class _SMTP(_TrackedSMTP, smtplib.SMTP):
+    pass
+
+
+
+
+class _SMTPSSL(_TrackedSMTP, smtplib.SMTP_SSL):
+    pass
+
+
+
+
+class EmailDispatcher:
+    """Envío de alertas por correo sin bloquear el bucle de eventos.
+
+    Las alertas entran en una cola acotada (submit no espera nunca) y un único hilo
+    propio las envía por una conexión SMTP que se abre una vez y se reutiliza: se
+    comprueba con NOOP si lleva un rato parada, se cierra tras SMTP_IDLE_CLOSE y se
+    reabre sola si el servidor la ha cortado. Tras cada envío, lo que llegue dentro
+    de EMAIL_DIGEST_WINDOW se agrupa en un único correo de resumen por destinatario.
+    Al cerrar, lo que quede pendiente se envía con un límite de EMAIL_DRAIN_TIMEOUT.
+    """
+
+    def __init__(self, maxsize=EMAIL_QUEUE_SIZE, window=EMAIL_DIGEST_WINDOW):
+        self.queue = asyncio.Queue(maxsize)
+        self.window = window
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._smtp = None
+        self._last_used = 0.0
+        self._quiet_until = 0.0
+        self._pending = []   # (destinatario, asunto, cuerpo) sacados de la cola y aún sin enviar
+        self._context = ssl.create_default_context() if SMTP_SECURITY != "plain" else None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smtp")
+
+
+    def submit(self, to_addr, subject, body) -> bool:
+        try:
+            self.queue.put_nowait((to_addr, subject, body))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"[ERROR] Cola de correo llena: alerta descartada ({self.dropped} en total)")
+            return False
+
+
+    # --- hilo SMTP ---
+    def _connect(self):
+        if SMTP_SECURITY == "ssl":
+            smtp = _SMTPSSL(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT, context=self._context)
+        else:
+            smtp = _SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                smtp.starttls(context=self._context)
+        try:
+            if SMTP_LOGIN:
+                smtp.login(GMAIL_USER, GMAIL_APP_PASS)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+
+
+    def _close(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+
+    def _deliver(self, msg):
+        # si el servidor había cerrado la conexión reutilizada, se reconecta y se reintenta
+        # una vez; sólo si falló antes de DATA: después el servidor puede haber aceptado el
+        # correo y reintentar lo mandaría dos veces
+        for attempt in (1, 2):
+            reused = self._smtp is not None
+            try:
+                if not reused:
+                    self._connect()
+                self._smtp.data_started = False
+                self._smtp.send_message(msg)
+                self._last_used = time.monotonic()
+                return
+            except OSError as e:   # incluye smtplib.SMTPException
+                started = self._smtp is not None and self._smtp.data_started
+                self._close()
+                dropped = isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError))
+                if attempt == 2 or not reused or started or not dropped:
+                    raise
+
+
+    def _keepalive(self):
+        if self._smtp is None:
+            return
+        if time.monotonic() - self._last_used >= SMTP_IDLE_CLOSE:
+            self._close()
+            return
+        try:
+            if self._smtp.noop()[0] != 250:
+                self._close()
+        except OSError:
+            self._close()
+
+
+    @staticmethod
+    def _message(to_addr, alerts):
+        return build_alert_email(to_addr, *alerts[0]) if len(alerts) == 1 else build_digest_email(to_addr, alerts)
+
+
+    def _take_pending(self):
+        """Saca de _pending las alertas del primer destinatario: (destinatario, [(asunto, cuerpo)])."""
+        to_addr = self._pending[0][0]
+        alerts = [(subject, body) for addr, subject, body in self._pending if addr == to_addr]
+        self._pending = [item for item in self._pending if item[0] != to_addr]
+        return to_addr, alerts
+
+
+    # --- bucle de eventos ---
+    async def _send(self, to_addr, alerts):
+        loop = asyncio.get_running_loop()
+        msg = self._message(to_addr, alerts)
+        try:
+            await loop.run_in_executor(self._executor, self._deliver, msg)
+            self.sent += 1
+            print(f"[EMAIL] Correo enviado correctamente a {to_addr} ({len(alerts)} alerta(s))")
+        except Exception as e:
+            self.failed += 1
+            print(f"[ERROR] Fallo al enviar correo: {e}")
+
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # sin conexión abierta no hay nada que mantener: se espera sin límite
+                item = await asyncio.wait_for(self.queue.get(), SMTP_KEEPALIVE if self._smtp else None)
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(self._executor, self._keepalive)
+                continue
+
+
+            # dentro de la ventana del último envío: se acumula hasta que termine (en
+            # _pending, para que close() lo envíe si el agente para antes)
+            self._pending.append(item)
+            while (remaining := self._quiet_until - loop.time()) > 0:
+                try:
+                    self._pending.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            while not self.queue.empty():
+                self._pending.append(self.queue.get_nowait())
+
+
+            while self._pending:
+                await self._send(*self._take_pending())
+            self._quiet_until = loop.time() + self.window
+
+
+    def close(self, timeout=EMAIL_DRAIN_TIMEOUT):
+        """Al parar el agente: envía lo pendiente (como mucho timeout segundos) y cierra la conexión."""
+        while not self.queue.empty():
+            self._pending.append(self.queue.get_nowait())
+        deadline = time.monotonic() + timeout
+        while self._pending and (remaining := deadline - time.monotonic()) > 0:
+            to_addr, alerts = self._take_pending()
+            try:
+                self._executor.submit(self._deliver, self._message(to_addr, alerts)).result(timeout=remaining)
+                self.sent += 1
+                print(f"[EMAIL] Correo enviado correctamente a {to_addr} ({len(alerts)} alerta(s))")
+            except TimeoutError:
+                print(f"[ERROR] Sin tiempo para enviar el correo a {to_addr} al cerrar")
+                break
+            except Exception as e:
+                self.failed += 1
+                print(f"[ERROR] Fallo al enviar correo: {e}")
+        if self._pending:
+            self.dropped += len(self._pending)
+            print(f"[ERROR] {len(self._pending)} alerta(s) sin enviar al cerrar")
+            self._pending = []
+        try:
+            self._executor.submit(self._close).result(timeout=max(1.0, deadline - time.monotonic()))
+        except TimeoutError:
+            pass
+        self._executor.shutdown(wait=False)
+
+
+
+
+EMAIL = EmailDispatcher()
+
+
+
+
+# --------------------------------------------------------------------
+# PERSISTENCIA DEL ESTADO
+# --------------------------------------------------------------------
+STATE_BACKEND = "json"       # "json" (compatible) o "journal" (diario binario + snapshot)
+STATE_FILE = "mib_state.json"
+JOURNAL_FILE = "mib_state.journal"
+SNAPSHOT_FILE = "mib_state.snap"
+JOURNAL_COMPACT_BYTES = 256 * 1024   # tamaño del diario a partir del cual se compacta
+STATE_FLUSH_INTERVAL = 2.0   # segundos entre escrituras agrupadas (write-behind)
+STATE_FSYNC = False          # fsync del fichero temporal antes del rename
+PERSIST_VOLATILE = False     # guardar también objetos RO que cambian constantemente
+
+
+DEFAULT_STORE = {
+    "1.3.6.1.4.1.28308.1.1.0": ("DisplayString", "Admin"),
+    "1.3.6.1.4.1.28308.1.2.0": ("DisplayString", "perezarancha28@gmail.com"),
+    "1.3.6.1.4.1.28308.1.3.0": ("Integer32", 0),
+    "1.3.6.1.4.1.28308.1.4.0": ("Integer32", 20),
+    "1.3.6.1.4.1.28308.1.5.0": ("DateAndTime", ""),
+}
+
+
+# escalares de solo lectura que sí se guardan: no se recalculan al arrancar. El resto de los
+# read-only de la MIB (cpuUsage, contadores, agregados) son VOLATILE_OIDS
+PERSISTENT_READ_ONLY = {"eventTime"}
+
+
+
+
+def _write_atomic(path, data: bytes, mode=0o666):
+    """Escribe path de una vez (fichero temporal y os.replace); mode, salvo la umask, desde la creación."""
+    tmp = path + ".tmp"
+    try:
+        os.unlink(tmp)   # uno que dejó una escritura interrumpida conservaría sus permisos
+    except FileNotFoundError:
+        pass
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "wb") as f:
+        f.write(data)
+        if STATE_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+
+
+class JsonStateBackend:
+    """Backend por defecto: el estado completo en mib_state.json."""
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mirror = {}
+
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "r") as f:
+            self.mirror = json.load(f)
+        return dict(self.mirror)
+
+
+    def save(self, state):
+        with self.lock:
+            self.mirror = dict(state)
+            _write_atomic(self.path, json.dumps(self.mirror, separators=(",", ":")).encode("utf-8"))
+
+
+    def write_changes(self, changes):
+        # el JSON no admite escrituras parciales: se aplica al espejo y se reescribe
+        with self.lock:
+            for oid, entry in changes.items():
+                if entry is None:
+                    self.mirror.pop(oid, None)
+                else:
+                    self.mirror[oid] = entry
+            _write_atomic(self.path, json.dumps(self.mirror, separators=(",", ":")).encode("utf-8"))
+
+
+
+
+# registro del diario: cabecera (crc32, longitud) + op, OID, sintaxis y valor
+_REC_HEADER = struct.Struct("!II")
+_OP_INT, _OP_STR, _OP_DEL = 1, 2, 3
+
+
+
+
+def _encode_record(oid: str, entry) -> bytes:
+    o = oid.encode("ascii")
+    if entry is None:
+        payload = struct.pack("!BH", _OP_DEL, len(o)) + o
+    else:
+        t, v = entry
+        tb = t.encode("ascii")
+        if isinstance(v, int):
+            payload = struct.pack("!BH", _OP_INT, len(o)) + o + struct.pack("!B", len(tb)) + tb + struct.pack("!q", v)
+        else:
+            payload = struct.pack("!BH", _OP_STR, len(o)) + o + struct.pack("!B", len(tb)) + tb + str(v).encode("utf-8")
+    return _REC_HEADER.pack(zlib.crc32(payload), len(payload)) + payload
+
+
+
+
+def _decode_records(data: bytes, state: dict) -> int:
+    """Aplica los registros sobre state; devuelve el offset del último registro íntegro."""
+    pos = 0
+    while pos + _REC_HEADER.size <= len(data):
+        crc, length = _REC_HEADER.unpack_from(data, pos)
+        start = pos + _REC_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break   # cola truncada por una caída a mitad de escritura
+        op, olen = struct.unpack_from("!BH", payload)
+        oid = payload[3:3 + olen].decode("ascii")
+        if op == _OP_DEL:
+            state.pop(oid, None)
+        else:
+            tlen = payload[3 + olen]
+            t = payload[4 + olen:4 + olen + tlen].decode("ascii")
+            raw = payload[4 + olen + tlen:]
+            state[oid] = (t, struct.unpack("!q", raw)[0] if op == _OP_INT else raw.decode("utf-8"))
+        pos = start + length
+    return pos
+
+
+
+
+class JournalStateBackend:
+    """Diario binario de solo-añadir con snapshots compactados: coste O(cambios) por escritura."""
+
+    def __init__(self, journal=JOURNAL_FILE, snapshot=SNAPSHOT_FILE, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.journal = journal
+        self.snapshot = snapshot
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.mirror = {}
+        self._fh = None
+
+
+    def load(self):
+        if not os.path.exists(self.snapshot) and not os.path.exists(self.journal):
+            # migración: primer arranque con diario partiendo de un mib_state.json existente
+            if os.path.exists(STATE_FILE):
+                legacy = JsonStateBackend().load()
+                self.save(legacy)
+                return legacy
+            return None
+
+        state = {}
+        if os.path.exists(self.snapshot):
+            with open(self.snapshot, "rb") as f:
+                _decode_records(f.read(), state)
+        if os.path.exists(self.journal):
+            with open(self.journal, "rb") as f:
+                data = f.read()
+            good = _decode_records(data, state)
+            if good < len(data):
+                print(f"[WARN] Diario truncado en el byte {good}, se descarta la cola")
+                with open(self.journal, "r+b") as f:
+                    f.truncate(good)
+        self.mirror = dict(state)
+        return state
+
+
+    def _journal(self):
+        if self._fh is None:
+            self._fh = open(self.journal, "ab")
+        return self._fh
+
+
+    def save(self, state):
+        # snapshot compacto (atómico) y diario vacío
+        with self.lock:
+            self.mirror = dict(state)
+            _write_atomic(self.snapshot, b"".join(_encode_record(o, e) for o, e in self.mirror.items()))
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            open(self.journal, "wb").close()
+
+
+    def write_changes(self, changes):
+        with self.lock:
+            fh = self._journal()
+            fh.write(b"".join(_encode_record(o, e) for o, e in changes.items()))
+            fh.flush()
+            if STATE_FSYNC:
+                os.fsync(fh.fileno())
+            for oid, entry in changes.items():
+                if entry is None:
+                    self.mirror.pop(oid, None)
+                else:
+                    self.mirror[oid] = entry
+            compact = fh.tell() >= self.compact_bytes
+        if compact:
+            self.save(self.mirror)
+
+
+
+
+def make_state_backend(kind=STATE_BACKEND):
+    if kind == "journal":
+        return JournalStateBackend()
+    return JsonStateBackend()
+
+
+
+
+BACKEND = make_state_backend()
+
+
+
+
+def save_state(state):
+    """Escritura completa del estado (atómica en ambos backends)."""
+    if not PERSIST_VOLATILE:
+        state = {oid: entry for oid, entry in state.items() if oid not in VOLATILE_OIDS}
+    try:
+        BACKEND.save(state)
+    except Exception as e:
+        print(f"[ERROR] No se pudo guardar el estado ({STATE_BACKEND}): {e}")
+
+
+
+
+def load_state():
+    state = DEFAULT_STORE.copy()
+    try:
+        loaded = BACKEND.load()
+    except Exception as e:
+        print(f"[ERROR] Estado ilegible, se usan valores por defecto: {e}")
+        loaded = None
+    if loaded is None:
+        save_state(state)
+        return state
+    state.update(loaded)
+    return state
+
+
+
+
+class StateWriter:
+    """Persistencia write-behind: marca OIDs sucios y agrupa las escrituras en disco."""
+
+    def __init__(self, source, backend, interval=STATE_FLUSH_INTERVAL):
+        # source: cualquier objeto con entry(oid) -> (sintaxis, valor) o None
+        self.source = source
+        self.backend = backend
+        self.interval = interval
+        self.dirty = set()
+
+
+    def mark_dirty(self, oid):
+        if PERSIST_VOLATILE or oid not in VOLATILE_OIDS:
+            self.dirty.add(oid)
+
+
+    def _take_changes(self):
+        # sólo las entradas modificadas: O(cambios), no O(registro)
+        changes = {oid: self.source.entry(oid) for oid in self.dirty}
+        self.dirty.clear()
+        return changes
+
+
+    def _write(self, changes):
+        try:
+            self.backend.write_changes(changes)
+            return True
+        except Exception as e:
+            print(f"[ERROR] No se pudo guardar el estado ({STATE_BACKEND}): {e}")
+            return False
+
+
+    def _retry_later(self, changes):
+        # la escritura falló: volver a marcar los OIDs para el siguiente volcado
+        # (entry() se relee entonces, así que se guarda el valor más reciente)
+        self.dirty.update(changes)
+
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        changes = self._take_changes()
+        if not await asyncio.get_running_loop().run_in_executor(None, self._write, changes):
+            self._retry_later(changes)
+
+
+    def flush_now(self):
+        # usado al cerrar el agente, cuando el loop ya no está corriendo
+        if self.dirty:
+            changes = self._take_changes()
+            if not self._write(changes):
+                self._retry_later(changes)
+
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+
+
+# --------------------------------------------------------------------
+# MOTOR SNMP — configuración de comunidades y permisos
+# --------------------------------------------------------------------
+# Identificador del motor: fijo entre arranques (por defecto pysnmp lo deriva del PID), para que
+# los gestores SNMPv3 no tengan que redescubrirlo y las claves localizadas sigan valiendo.
+# 0x80 + empresa 28308 (0x6e94) + formato 4 (texto)
+SNMP_ENGINE_ID = b"\x80\x00\x6e\x94\x04" + ("mini-agent-" + socket.gethostname()).encode("utf-8")[:27]
+
+
+snmp_engine = SnmpEngine(snmpEngineID=v2c.OctetString(SNMP_ENGINE_ID))
+snmpContext = context.SnmpContext(snmp_engine)
+
+
+# Vista de cada securityName: "ro" sólo lectura, "rw" lectura y escritura
+SECURITY_NAMES = {"public-area": "ro", "private-area": "rw"}
+
+
+# Asignar vistas de acceso por modelo de seguridad (v1 y v2c)
+for _name, _access in SECURITY_NAMES.items():
+    for secModel in (1, 2):
+        config.addVacmUser(
+            snmp_engine,
+            secModel,
+            _name,
+            "noAuthNoPriv",
+            readSubTree=(1, 3, 6, 1),
+            writeSubTree=(1, 3, 6, 1) if _access == "rw" else ()
+        )
+
+
+# Usuarios SNMPv3 (USM, siempre authPriv). Las contraseñas no van en el código: se leen de
+# V3_USERS_FILE, una lista JSON con user, auth, auth_key, priv, priv_key y access ("ro" o
+# "rw", la misma vista que public/private); ver v3_users.example.json. La variable de
+# entorno MINI_AGENT_V3_USERS cambia la ruta. Valen en todos los listeners.
+V3_USERS_FILE = os.environ.get("MINI_AGENT_V3_USERS",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "v3_users.json"))
+
+
+
+
+def load_v3_users(path=V3_USERS_FILE):
+    """Usuarios SNMPv3 de path; sin fichero no hay SNMPv3."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            users = json.load(f)
+    except FileNotFoundError:
+        print(f"[WARN] Sin {path}: SNMPv3 desactivado")
+        return []
+    if os.stat(path).st_mode & 0o077:
+        print(f"[WARN] {path} tiene contraseñas y lo pueden leer otros usuarios (chmod 600)")
+    return users
+
+
+V3_USERS = load_v3_users()
+USM_AUTH_PROTOCOLS = {
+    "md5": config.USM_AUTH_HMAC96_MD5,
+    "sha": config.USM_AUTH_HMAC96_SHA,
+    "sha256": config.USM_AUTH_HMAC192_SHA256,
+    "sha512": config.USM_AUTH_HMAC384_SHA512,
+}
+USM_PRIV_PROTOCOLS = {
+    "des": config.USM_PRIV_CBC56_DES,
+    "aes": config.USM_PRIV_CFB128_AES,
+    "aes256": config.USM_PRIV_CFB256_AES,
+}
+USM_KEY_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".usm_cache")
+
+
+
+
+def usm_key_digest(user):
+    """Huella de lo que determina las claves de un usuario (nombre, protocolos y contraseñas)."""
+    fields = [user["user"], user["auth"], user["auth_key"], user["priv"], user["priv_key"]]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+
+
+def localize_usm_keys(user, engine_id):
+    """Claves de autenticación y cifrado localizadas para engine_id (RFC 3414, A.2).
+
+    Es lo caro de USM: cada contraseña se expande a 1 MB y se resume, y luego se mezcla
+    con el identificador del motor.
+    """
+    usm = snmp_engine.securityModels[3]
+    auth = USM_AUTH_PROTOCOLS[user["auth"]]
+    priv = USM_PRIV_PROTOCOLS[user["priv"]]
+    engine_id = v2c.OctetString(engine_id)
+    auth_service, priv_service = usm.AUTH_SERVICES[auth], usm.PRIV_SERVICES[priv]
+    auth_key = auth_service.localizeKey(auth_service.hashPassphrase(v2c.OctetString(user["auth_key"])), engine_id)
+    priv_key = priv_service.localizeKey(auth, priv_service.hashPassphrase(auth, v2c.OctetString(user["priv_key"])),
+                                        engine_id)
+    return bytes(auth_key), bytes(priv_key)
+
+
+
+
+def load_usm_keys(users, engine_id=SNMP_ENGINE_ID):
+    """Claves localizadas de users, de la caché en disco de este engine ID o calculadas.
+
+    La caché va en un fichero por engine ID; si algún usuario ha cambiado se reescribe
+    sólo con los actuales.
+    """
+    path = os.path.join(USM_KEY_CACHE_DIR, engine_id.hex() + ".json")
+    try:
+        with open(path, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    keys, fresh = {}, {}
+    for user in users:
+        digest = usm_key_digest(user)
+        if digest in cached:
+            fresh[digest] = cached[digest]
+        else:
+            fresh[digest] = [key.hex() for key in localize_usm_keys(user, engine_id)]
+        keys[user["user"]] = tuple(bytes.fromhex(key) for key in fresh[digest])
+    if fresh != cached:
+        try:
+            os.makedirs(USM_KEY_CACHE_DIR, mode=0o700, exist_ok=True)
+            os.chmod(USM_KEY_CACHE_DIR, 0o700)   # makedirs no cambia uno que ya existía
+            _write_atomic(path, json.dumps(fresh).encode("utf-8"), mode=0o600)
+        except OSError as e:
+            print(f"[WARN] No se pudo guardar la caché de claves USM: {e}")
+    return keys
+
+
+
+
+def add_v3_users(users=V3_USERS):
+    """Da de alta los usuarios USM con sus claves ya localizadas y su vista VACM."""
+    for user in users:
+        if user["auth"] not in USM_AUTH_PROTOCOLS or user["priv"] not in USM_PRIV_PROTOCOLS:
+            raise ValueError(f"protocolo USM desconocido para {user['user']}: {user['auth']}/{user['priv']}")
+        if user["access"] not in ("ro", "rw"):
+            raise ValueError(f"acceso desconocido para {user['user']}: {user['access']}")
+    keys = load_usm_keys(users)
+    for user in users:
+        auth_key, priv_key = keys[user["user"]]
+        config.addV3User(
+            snmp_engine, user["user"],
+            USM_AUTH_PROTOCOLS[user["auth"]], auth_key,
+            USM_PRIV_PROTOCOLS[user["priv"]], priv_key,
+            authKeyType=config.USM_KEY_TYPE_LOCALIZED,
+            privKeyType=config.USM_KEY_TYPE_LOCALIZED
+        )
+        config.addVacmUser(
+            snmp_engine,
+            3,
+            user["user"],
+            "authPriv",
+            readSubTree=(1, 3, 6, 1),
+            writeSubTree=(1, 3, 6, 1) if user["access"] == "rw" else ()
+        )
+        SECURITY_NAMES[user["user"]] = user["access"]
+
+
+
+
+add_v3_users()
+
+
+# Puntos de escucha. Cada uno: tipo ("udp", "udp6" o "unix"), dirección (host y puerto, o la
+# ruta del socket) y sus comunidades, cada una con el securityName (y por tanto la vista) que
+# le corresponde en ese punto. Una comunidad que no figura en un listener no vale en él.
+LISTENERS = [
+    {"name": "ipv4", "kind": "udp", "address": ("0.0.0.0", 1161),
+     "communities": {"public": "public-area", "private": "private-area"}},
+    {"name": "ipv6", "kind": "udp6", "address": ("::", 1161),
+     "communities": {"public": "public-area", "private": "private-area"}},
+    # clientes de la misma máquina (pruebas, sidecars): sin pila UDP/IP por petición
+    {"name": "local", "kind": "unix", "address": "/tmp/mini_agent.sock",
+     "communities": {"public": "public-area", "private": "private-area"}},
+]
+
+
+# transportDomainLocal (TRANSPORT-ADDRESS-MIB): datagramas por socket Unix
+UNIX_DOMAIN_NAME = (1, 3, 6, 1, 2, 1, 100, 1, 13)
+
+
+
+
+class UnixDgramTransport(DgramAsyncioProtocol):
+    """Transporte de pysnmp sobre un socket Unix de datagramas.
+
+    La dirección del cliente es la ruta a la que ha hecho bind (str, o bytes si es
+    abstracta) y se devuelve tal cual.
+    """
+    SOCK_FAMILY = socket.AF_UNIX
+    ADDRESS_TYPE = str
+
+
+    def normalizeAddress(self, transportAddress):
+        return transportAddress
+
+
+
+
+# tipo -> (dominio de transporte, clase del transporte, familia de socket)
+TRANSPORT_KINDS = {
+    "udp": (udp.DOMAIN_NAME, udp.UdpTransport, socket.AF_INET),
+    "udp6": (udp6.DOMAIN_NAME, udp6.Udp6Transport, socket.AF_INET6),
+    "unix": (UNIX_DOMAIN_NAME, UnixDgramTransport, socket.AF_UNIX),
+}
+
+
+LISTENER_COMMUNITIES = {}   # dominio -> {comunidad (bytes): securityName} de cada listener abierto
+OPEN_TRANSPORTS = {}        # dominio -> (transporte, ruta del socket Unix o None)
+
+
+
+
+def listener_domain(listener):
+    """Dominio propio de cada listener: el del tipo para el primero, con un sufijo para los demás.
+
+    El primer "udp" conserva udp.DOMAIN_NAME, que es por donde salen las notificaciones.
+    """
+    base = TRANSPORT_KINDS[listener["kind"]][0]
+    same = [other for other in LISTENERS if other["kind"] == listener["kind"]]
+    number = next((i for i, other in enumerate(same) if other is listener), len(same))
+    return base if number == 0 else base + (number,)
+
+
+
+
+def listener_socket(kind, address, reuse_port=False):
+    sock = socket.socket(TRANSPORT_KINDS[kind][2], socket.SOCK_DGRAM)
+    if kind == "udp6":
+        # sin esto "::" ocupa también el puerto IPv4 y choca con el listener de 0.0.0.0
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+    if reuse_port:
+        # varios procesos con el mismo puerto; el kernel reparte los datagramas
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if kind == "unix" and os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+        os.unlink(address)   # socket de una ejecución anterior
+    sock.bind(address)
+    sock.setblocking(False)
+    return sock
+
+
+
+
+def add_transport(domain, kind, address, reuse_port=False):
+    sock = listener_socket(kind, address, reuse_port)
+    transport = TRANSPORT_KINDS[kind][1]().openServerMode(sock=sock)
+    config.addTransport(snmp_engine, domain, transport)
+    OPEN_TRANSPORTS[domain] = (transport, address if kind == "unix" else None)
+    return sock.getsockname()
+
+
+
+
+def open_listener(listener, reuse_port=False):
+    """Abre un listener de LISTENERS y registra sus comunidades para su dominio."""
+    domain = listener_domain(listener)
+    bound = add_transport(domain, listener["kind"], listener["address"], reuse_port)
+    LISTENER_COMMUNITIES[domain] = {community.encode(): v2c.OctetString(name)
+                                    for community, name in listener["communities"].items()}
+    return bound
+
+
+
+
+def open_listeners(kinds=None, reuse_port=False):
+    """Abre los listeners (los de kinds, si se indica); uno que falla se avisa y se salta."""
+    opened = []
+    for listener in LISTENERS:
+        if kinds is not None and listener["kind"] not in kinds:
+            continue
+        try:
+            open_listener(listener, reuse_port)
+        except OSError as exc:
+            print(f"[WARN] No se puede abrir {listener['name']} ({listener['kind']} {listener['address']}): {exc}")
+            continue
+        opened.append(listener)
+    return opened
+
+
+
+
+def open_transport(address=("0.0.0.0", 0), reuse_port=False, kind="udp"):
+    """Transporte sin comunidades en el dominio base de kind: origen de las notificaciones
+    cuando ningún listener de este proceso lo ocupa (y transporte de los benchmarks)."""
+    return add_transport(TRANSPORT_KINDS[kind][0], kind, address, reuse_port)
+
+
+
+
+def address_kind(address):
+    """Tipo de transporte por el que se llega a una dirección: ruta Unix, IPv6 o IPv4."""
+    if isinstance(address, str):
+        return "unix"
+    return "udp6" if ":" in address[0] else "udp"
+
+
+
+
+def address_key(domain, address):
+    """(dominio, dirección) comparable entre destinos configurados y datagramas recibidos."""
+    return domain, address if isinstance(address, str) else tuple(address[:2])
+
+
+
+
+def close_listeners():
+    for domain, (transport, path) in list(OPEN_TRANSPORTS.items()):
+        transport.closeTransport()
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
+    OPEN_TRANSPORTS.clear()
+    LISTENER_COMMUNITIES.clear()
+
+
+
+
+class ListenerCommunityModel:
+    """Resolución de comunidades de v1/v2c por listener.
+
+    Lo que llega a un listener se busca en sus propias comunidades; las respuestas a INFORM
+    de los destinos de notificación siguen por la tabla de comunidades del motor, que las
+    asocia al securityName del destino por su dirección.
+    """
+    _engine_id = None   # snmpEngineID del motor, resuelto en el primer mensaje (no cambia)
+
+    def _com2sec(self, snmpEngine, communityName, transportInformation):
+        domain, address = tuple(transportInformation[0]), transportInformation[1]
+        communities = LISTENER_COMMUNITIES.get(domain)
+        if communities is not None and address_key(domain, address) not in TARGET_ADDRESSES:
+            security_name = communities.get(bytes(communityName))
+            if security_name is not None:
+                if self._engine_id is None:
+                    (engine_id,) = snmpEngine.msgAndPduDsp.mibInstrumController.mibBuilder.importSymbols(
+                        "__SNMP-FRAMEWORK-MIB", "snmpEngineID")
+                    self._engine_id = engine_id.syntax
+                return security_name, self._engine_id, b""
+        return super()._com2sec(snmpEngine, communityName, transportInformation)
+
+
+
+
+class ListenerV1SecurityModel(ListenerCommunityModel, rfc2576.SnmpV1SecurityModel):
+    pass
+
+
+
+
+class ListenerV2cSecurityModel(ListenerCommunityModel, rfc2576.SnmpV2cSecurityModel):
+    pass
+
+
+
+
+for _model in (ListenerV1SecurityModel(), ListenerV2cSecurityModel()):
+    snmp_engine.securityModels[_model.SECURITY_MODEL_ID] = _model
+
+
+
+# Los destinos de traps/INFORM se dan de alta en NOTIFICACIONES (NOTIFICATION_TARGETS)
+
+
+# --------------------------------------------------------------------
+# FUNCIONES AUXILIARES
+# --------------------------------------------------------------------
+CPU_OID = "1.3.6.1.4.1.28308.1.3.0"
+THRESH_OID = "1.3.6.1.4.1.28308.1.4.0"
+EMAIL_OID = "1.3.6.1.4.1.28308.1.2.0"
+EVENTTIME_OID = "1.3.6.1.4.1.28308.1.5.0"
+
+
+
+
+def oid_to_tuple(oid) -> tuple:
+    """Convierte un OID ("1.3.6..." u ObjectIdentifier) en tupla de enteros."""
+    if isinstance(oid, str):
+        return tuple(int(x) for x in oid.strip(".").split("."))
+    return tuple(oid)
+
+
+
+
+class OidIndex:
+    """Índice ordenado de OIDs (tuplas de enteros) con búsqueda binaria del sucesor."""
+
+    def __init__(self, oids=()):
+        self._keys = []
+        self._names = {}
+        for o in oids:
+            self.add(o)
+
+
+    def add(self, oid: str):
+        key = oid_to_tuple(oid)
+        if key not in self._names:
+            insort(self._keys, key)
+            self._names[key] = oid
+
+
+    def remove(self, oid: str):
+        key = oid_to_tuple(oid)
+        if self._names.pop(key, None) is not None:
+            del self._keys[bisect_right(self._keys, key) - 1]
+
+
+    def next(self, oid):
+        """Devuelve (tupla, cadena) del primer OID estrictamente mayor, o None."""
+        pos = bisect_right(self._keys, oid_to_tuple(oid))
+        if pos == len(self._keys):
+            return None
+        key = self._keys[pos]
+        return key, self._names[key]
+
+
+    def __contains__(self, oid):
+        return oid_to_tuple(oid) in self._names
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+
+
+def make_varbind(name, value):
+    vb = v2c.VarBind()
+    v2c.apiVarBind.setOIDVal(vb, (name, value))
+    return vb
+
+
+
+
+def set_varbinds(pdu, varbinds):
+    # como v2c.apiPDU.setVarBinds, pero inserta los VarBind ya construidos sin
+    # volver a copiar OID y valor componente a componente
+    vbl = pdu.setComponentByPosition(3).getComponentByPosition(3)
+    vbl.clear()
+    for idx, vb in enumerate(varbinds):
+        if isinstance(vb, v2c.VarBind):
+            vbl.setComponentByPosition(idx, vb)
+        else:
+            vbl.setComponentByPosition(idx)
+            v2c.apiVarBind.setOIDVal(vbl.getComponentByPosition(idx), vb)
+
+
+
+
+def varbind_size(vb):
+    return len(encoder.encode(vb if isinstance(vb, v2c.VarBind) else make_varbind(*vb)))
+
+
+
+
+# --------------------------------------------------------------------
+# COMPILADOR DE LA MIB (MYAGENT-MIB.txt -> definiciones, con caché en disco)
+# --------------------------------------------------------------------
+MIB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MYAGENT-MIB.txt")
+MIB_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".mib_cache")
+MIB_COMPILER_VERSION = 3   # cambiarlo invalida las cachés generadas por versiones anteriores
+
+
+# raíces importadas de SNMPv2-SMI
+MIB_ROOTS = {
+    "iso": (1,),
+    "org": (1, 3),
+    "internet": (1, 3, 6, 1),
+    "enterprises": (1, 3, 6, 1, 4, 1),
+}
+
+
+# tipos de la MIB -> sintaxis soportada por el agente
+MIB_TYPES = {
+    "INTEGER": "Integer32",
+    "Integer32": "Integer32",
+    "Counter32": "Counter32",
+    "Gauge32": "Gauge32",
+    "Counter64": "Counter64",
+    "DisplayString": "DisplayString",
+    "OCTET": "DisplayString",
+    "DateAndTime": "DateAndTime",
+    "RowStatus": "RowStatus",
+}
+
+
+_RE_STRING = re.compile(r'"[^"]*"')
+_RE_DEFINITION = re.compile(
+    r"([a-z][\w-]*)\s+(OBJECT\s+IDENTIFIER|MODULE-IDENTITY|OBJECT-IDENTITY|OBJECT-TYPE|NOTIFICATION-TYPE)"
+    r"(.*?)::=\s*\{\s*([A-Za-z][\w-]*)\s+(\d+)\s*\}", re.S)
+
+
+
+
+def _parse_syntax(text):
+    """'Integer32 (0..100)' / 'DisplayString (SIZE (5..128))' -> (tipo, restricciones, enums)."""
+    text = " ".join(text.split())
+    enums = {name: int(num) for name, num in re.findall(r"([a-z][\w-]*)\s*\(\s*(-?\d+)\s*\)", text)}
+    base = text.split()[0] if text else ""
+    constraints = None
+    m = re.search(r"\(\s*(?:SIZE\s*\(\s*)?(-?\d+)\s*\.\.\s*(-?\d+)", text)
+    if m:
+        constraints = [int(m.group(1)), int(m.group(2))]
+    elif enums:
+        constraints = [min(enums.values()), max(enums.values())]
+    return base, constraints, enums
+
+
+
+
+def compile_mib(text):
+    """Compila las definiciones de un módulo SMIv2 en {nombre: definición}."""
+    text = re.sub(r"--[^\n]*", "", text)
+    strings = []
+
+
+    def keep(m):
+        strings.append(m.group(0)[1:-1])
+        return f"__STR{len(strings) - 1}__"
+
+
+    text = _RE_STRING.sub(keep, text)
+    defs = {}
+    parents = {}
+    for name, kind, body, parent, sub in _RE_DEFINITION.findall(text):
+        parents[name] = (parent, int(sub))
+        d = {"kind": " ".join(kind.split())}
+        if d["kind"] == "OBJECT-TYPE":
+            syntax = re.search(r"SYNTAX\s+(.*?)\s+(?:UNITS|MAX-ACCESS|ACCESS)\b", body, re.S)
+            base, constraints, enums = _parse_syntax(syntax.group(1) if syntax else "")
+            d["syntax"] = MIB_TYPES.get(base, base)
+            d["constraints"] = constraints
+            if enums:
+                d["enums"] = enums
+            access = re.search(r"MAX-ACCESS\s+([\w-]+)", body)
+            d["access"] = access.group(1) if access else "not-accessible"
+            defval = re.search(r"DEFVAL\s*\{\s*(.*?)\s*\}", body, re.S)
+            if defval:
+                raw = defval.group(1)
+                m = re.fullmatch(r"__STR(\d+)__", raw)
+                d["defval"] = strings[int(m.group(1))] if m else (int(raw) if re.fullmatch(r"-?\d+", raw) else enums.get(raw, raw))
+            index = re.search(r"INDEX\s*\{(.*?)\}", body, re.S)
+            if index:
+                d["index"] = [x.strip() for x in index.group(1).split(",")]
+        elif d["kind"] == "NOTIFICATION-TYPE":
+            objects = re.search(r"OBJECTS\s*\{(.*?)\}", body, re.S)
+            d["objects"] = [x.strip() for x in objects.group(1).split(",")] if objects else []
+        defs[name] = d
+
+
+    def resolve(name, seen=()):
+        if name in MIB_ROOTS:
+            return MIB_ROOTS[name]
+        if name not in parents or name in seen:
+            raise ValueError(f"OID sin resolver en la MIB: {name}")
+        parent, sub = parents[name]
+        return resolve(parent, seen + (name,)) + (sub,)
+
+
+    for name, d in defs.items():
+        d["oid"] = list(resolve(name))
+        d["parent"] = parents[name][0]
+    return defs
+
+
+
+
+def load_mib(path=MIB_FILE):
+    """Devuelve la MIB compilada, reutilizando la caché si el hash del fichero no ha cambiado."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw + str(MIB_COMPILER_VERSION).encode()).hexdigest()
+    module = os.path.splitext(os.path.basename(path))[0]
+    cache = os.path.join(MIB_CACHE_DIR, f"{module}.json")
+    try:
+        with open(cache, "r") as f:
+            cached = json.load(f)
+        if cached.get("sha256") == digest:
+            return cached["objects"]
+    except (OSError, ValueError):
+        pass
+
+    objects = compile_mib(raw.decode("utf-8"))
+    try:
+        os.makedirs(MIB_CACHE_DIR, exist_ok=True)
+        _write_atomic(cache, json.dumps({"sha256": digest, "objects": objects}).encode("utf-8"))
+    except OSError as e:
+        print(f"[WARN] No se pudo guardar la caché de la MIB: {e}")
+    print(f"[MIB] {module} compilada ({len(objects)} definiciones)")
+    return objects
+
+
+
+
+MIB = load_mib()
+
+
+
+
+# --------------------------------------------------------------------
+# REGISTRO DE OBJETOS GESTIONADOS
+# --------------------------------------------------------------------
+# sintaxis -> (clase pysnmp, conversión del valor python a la clase, conversión de la petición)
+SYNTAXES = {
+    "Integer32": (v2c.Integer, int, int),
+    "Counter32": (v2c.Counter32, lambda v: int(v) & 0xFFFFFFFF, int),
+    "Gauge32": (v2c.Gauge32, lambda v: min(max(int(v), 0), 0xFFFFFFFF), int),
+    "Counter64": (v2c.Counter64, lambda v: int(v) & 0xFFFFFFFFFFFFFFFF, int),
+    "DisplayString": (v2c.OctetString, str, lambda val: val.prettyPrint()),
+    "DateAndTime": (v2c.OctetString, lambda v: v.encode("utf-8"), lambda val: val.prettyPrint()),
+    "RowStatus": (v2c.Integer, int, int),
+}
+
+
+# valores de RowStatus (SNMPv2-TC)
+ACTIVE, NOT_IN_SERVICE, NOT_READY, CREATE_AND_GO, CREATE_AND_WAIT, DESTROY = range(1, 7)
+
+
+# caché de varbinds de respuesta ya construidos (VarBind de pyasn1) en cada objeto;
+# se invalida sólo cuando cambia su valor
+CACHE_VARBINDS = True
+
+
+
+
+def check_value(spec, val) -> int:
+    """Devuelve 0 si el valor es aceptable o el código de error SNMP (wrongType/wrongValue)."""
+    if not isinstance(val, spec._asn1):
+        return 7
+    if spec.lo is None:
+        return 0
+    n = int(val) if issubclass(spec._asn1, univ.Integer) else len(val)
+    return 0 if spec.lo <= n <= spec.hi else 10
+
+
+
+
+class ManagedObject:
+    """Objeto escalar: OID, sintaxis, acceso, restricciones, valor y hooks get/set."""
+
+    __slots__ = ("oid", "key", "name", "syntax", "access", "lo", "hi", "value",
+                 "getter", "setter", "sampler", "_asn1", "_encode", "_decode", "_vb", "_size")
+
+    def __init__(self, oid, name, syntax, access="read-only", constraints=None, value=None,
+                 getter=None, setter=None):
+        self.oid = oid
+        self.key = oid_to_tuple(oid)
+        self.name = name
+        self.syntax = syntax
+        self.access = access
+        # rango (Integer32) o tamaño (cadenas); None = sin límite
+        self.lo, self.hi = constraints if constraints else (None, None)
+        self._asn1, self._encode, self._decode = SYNTAXES[syntax]
+        self.value = value if value is not None else (0 if issubclass(self._asn1, univ.Integer) else "")
+        self.getter = getter
+        self.setter = setter
+        self.sampler = None   # Sampler que refresca value bajo demanda (ver MUESTREO)
+        self._vb = None
+        self._size = None
+
+
+    @property
+    def writable(self):
+        return self.access == "read-write"
+
+
+    def get(self):
+        return self.getter(self) if self.getter else self.value
+
+
+    def validate(self, val) -> int:
+        return check_value(self, val)
+
+
+    def decode(self, val):
+        return self._decode(val)
+
+
+    def set(self, value):
+        self.value = value
+        self._vb = None
+        self._size = None
+        if self.setter:
+            self.setter(self, value)
+
+
+    def varbind(self):
+        if self.sampler is not None:
+            self.sampler.touch()
+        vb = self._vb
+        if vb is None:
+            vb = make_varbind(v2c.ObjectIdentifier(self.key), self._asn1(self._encode(self.get())))
+            if CACHE_VARBINDS and self.getter is None:
+                self._vb = vb
+        return vb
+
+
+    def varbind_size(self):
+        size = self._size
+        if size is None:
+            size = varbind_size(self.varbind())
+            if self._vb is not None:
+                self._size = size
+        return size
+
+
+
+
+class Column:
+    """Definición de una columna de tabla; los valores viven en la tabla, no aquí."""
+
+    __slots__ = ("subid", "name", "syntax", "access", "lo", "hi", "default",
+                 "_asn1", "_encode", "_decode")
+
+    def __init__(self, subid, name, syntax, access="read-only", constraints=None, default=None):
+        self.subid = subid
+        self.name = name
+        self.syntax = syntax
+        self.access = access
+        if syntax == "RowStatus" and not constraints:
+            constraints = (ACTIVE, DESTROY)
+        self.lo, self.hi = constraints if constraints else (None, None)
+        self._asn1, self._encode, self._decode = SYNTAXES[syntax]
+        self.default = default if default is not None else (0 if issubclass(self._asn1, univ.Integer) else "")
+
+
+    @property
+    def readable(self):
+        return self.access != "not-accessible"
+
+
+    @property
+    def writable(self):
+        return self.access in ("read-write", "read-create")
+
+
+    def validate(self, val) -> int:
+        return check_value(self, val)
+
+
+    def decode(self, val):
+        return self._decode(val)
+
+
+
+
+class MibTable:
+    """Tabla conceptual SNMP: filas indexadas por tuplas de enteros y valores por columnas.
+
+    Cada columna es un array('q') (enteros) o una lista (cadenas) y una fila es una
+    posición en ellas, así que recorrer la tabla no crea un objeto Python por celda.
+    """
+
+    def __init__(self, name, entry_oid, columns, index_names=(), persistent=False):
+        self.name = name
+        self.entry = tuple(entry_oid)
+        self.columns = {c.subid: c for c in columns}
+        self.by_name = {c.name: c for c in columns}
+        self.readable = sorted(c.subid for c in columns if c.readable)
+        # columnas que forman el índice: su valor sale del propio índice
+        self._index_cols = {self.by_name[n].subid: i for i, n in enumerate(index_names) if n in self.by_name}
+        self.index_len = len(index_names) or 1
+        self.row_status = next((c.subid for c in columns if c.syntax == "RowStatus"), None)
+        self.persistent = persistent
+        # lo que se guarda de una tabla persistente: lo que escribe el gestor, no lo que
+        # calcula el agente (ruleValue, ruleState), que al arrancar vuelve a su valor por defecto
+        self.persisted = {c.subid for c in columns if c.writable and c.subid not in self._index_cols}
+        self.on_change = None
+        self.validator = None   # (columna, valor) -> error SNMP o 0, para comprobaciones de contenido
+        self.sampler = None
+        self.version = 0    # sube con cada cambio (RegistrySnapshot no republica tablas iguales)
+        self.rows = []      # índices ordenados (para GETNEXT)
+        self._pos = {}      # índice -> posición en las columnas
+        self._slots = []    # posición -> índice
+        self._data = {c.subid: (array("q") if issubclass(c._asn1, univ.Integer) else [])
+                      for c in columns if c.subid not in self._index_cols}
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def has_row(self, index):
+        return index in self._pos
+
+
+    def add_row(self, index, **values):
+        index = tuple(index)
+        if index in self._pos:
+            return
+        self._pos[index] = len(self._slots)
+        self._slots.append(index)
+        for subid, data in self._data.items():
+            col = self.columns[subid]
+            data.append(values.get(col.name, col.default))
+        insort(self.rows, index)
+        self.version += 1
+
+
+    def remove_row(self, index):
+        pos = self._pos.pop(tuple(index), None)
+        if pos is None:
+            return
+        # la última fila ocupa el hueco: borrado O(1) en las columnas
+        last = len(self._slots) - 1
+        moved = self._slots.pop()
+        if pos != last:
+            self._pos[moved] = pos
+            self._slots[pos] = moved
+            for data in self._data.values():
+                data[pos] = data[last]
+        for data in self._data.values():
+            data.pop()
+        del self.rows[bisect_left(self.rows, tuple(index))]
+        self.version += 1
+
+
+    def recycle_row(self, old, new, **values):
+        """Sustituye la fila old por new en su misma posición de las columnas (anillos).
+
+        No reserva memoria ni mueve datos en las columnas: sólo se sobrescribe cada celda.
+        """
+        old, new = tuple(old), tuple(new)
+        pos = self._pos.pop(old)
+        self._pos[new] = pos
+        self._slots[pos] = new
+        for subid, data in self._data.items():
+            col = self.columns[subid]
+            data[pos] = values.get(col.name, col.default)
+        del self.rows[bisect_left(self.rows, old)]
+        insort(self.rows, new)
+        self.version += 1
+
+
+    def clear(self):
+        self.rows.clear()
+        self._pos.clear()
+        self._slots.clear()
+        for subid in self._data:
+            self._data[subid] = array("q") if isinstance(self._data[subid], array) else []
+        self.version += 1
+
+
+    def set_rows(self, indexes):
+        """Sustituye el conjunto de filas (en orden) dejando las columnas con sus valores por defecto."""
+        self.clear()
+        self._slots = [tuple(index) for index in indexes]
+        self._pos = {index: i for i, index in enumerate(self._slots)}
+        self.rows = sorted(self._pos)
+        for subid, data in self._data.items():
+            default = self.columns[subid].default
+            self._data[subid] = (array("q", [default]) if isinstance(data, array) else [default]) * len(self.rows)
+
+
+    def dump(self):
+        """Filas y columnas tal cual, para copiarlas a otro proceso (ver restore)."""
+        return self._slots, self._data
+
+
+    def restore(self, state):
+        self._slots, self._data = state
+        self._pos = {index: i for i, index in enumerate(self._slots)}
+        self.rows = sorted(self._pos)
+
+
+    def set_column(self, name, values):
+        """Actualiza una columna entera en una sola pasada (valores en el orden de set_rows)."""
+        subid = self.by_name[name].subid
+        data = self._data[subid]
+        self._data[subid] = array("q", values) if isinstance(data, array) else list(values)
+        self.version += 1
+
+
+    def get_cell(self, name, index):
+        return self.cell_value(self.by_name[name].subid, tuple(index))
+
+
+    def set_cell(self, name, index, value):
+        data = self._data[self.by_name[name].subid]
+        pos = self._pos[tuple(index)]
+        if data[pos] != value:
+            data[pos] = value
+            self.version += 1
+
+
+    def cell_value(self, subid, index):
+        pos = self._index_cols.get(subid)
+        if pos is not None:
+            return index[pos]
+        return self._data[subid][self._pos[index]]
+
+
+    def cell_oid(self, subid, index):
+        return self.entry + (subid,) + tuple(index)
+
+
+    def varbind(self, subid, index):
+        if self.sampler is not None:
+            self.sampler.touch()
+        col = self.columns[subid]
+        return make_varbind(v2c.ObjectIdentifier(self.cell_oid(subid, index)),
+                            col._asn1(col._encode(self.cell_value(subid, index))))
+
+
+    def split(self, key):
+        """OID de celda -> (subid, índice) si pertenece a una columna de la tabla."""
+        n = len(self.entry)
+        if key[:n] != self.entry or len(key) < n + 2 or key[n] not in self.columns:
+            return None
+        return key[n], key[n + 1:]
+
+
+    def first_row(self):
+        return self.rows[0] if self.rows else None
+
+
+    def row_after(self, index):
+        """Primera fila con índice mayor que index (que puede ser incompleto o sobrar)."""
+        p = bisect_right(self.rows, index)
+        return self.rows[p] if p < len(self.rows) else None
+
+
+    def next_cell(self, key):
+        """Primera celda legible posterior a key, recorriendo columna a columna."""
+        first = self.first_row()
+        if first is None or not self.readable:
+            return None
+        n = len(self.entry)
+        head = key[:n]
+        if head < self.entry or key == self.entry:
+            return self.readable[0], first
+        if head > self.entry:
+            return None
+        c, rest = key[n], key[n + 1:]
+        i = bisect_left(self.readable, c)
+        if i < len(self.readable) and self.readable[i] == c:
+            row = self.row_after(rest)
+            if row is not None:
+                return c, row
+            i += 1
+        if i < len(self.readable):
+            return self.readable[i], first
+        return None
+
+
+    def check_set(self, subid, index, val, creating, orphans, idx):
+        """Valida un SET sobre una celda; registra creaciones (RowStatus) y celdas sin fila."""
+        col = self.columns[subid]
+        if not col.writable:
+            return 17   # notWritable
+        status = col.validate(val)
+        if not status and self.validator is not None:
+            status = self.validator(col.name, col.decode(val))
+        if status:
+            return status
+        if len(index) != self.index_len:
+            return 11   # noCreation
+        exists = index in self._pos
+        if subid == self.row_status:
+            v = int(val)
+            if v in (CREATE_AND_GO, CREATE_AND_WAIT):
+                if exists or (self, index) in creating:
+                    return 12   # inconsistentValue
+                creating[(self, index)] = v
+            elif v in (ACTIVE, NOT_IN_SERVICE):
+                if not exists:
+                    return 12
+            elif v != DESTROY:
+                return 10       # notReady no se puede escribir
+        elif not exists:
+            orphans.setdefault((self, index), idx)
+        return 0
+
+
+
+
+HISTORY_SIZE = 720   # muestras por métrica en historyTable (1 h a 5 s)
+
+
+
+
+class HistoryRing:
+    """Últimas size muestras de una métrica: dos array('q') de tamaño fijo y un contador."""
+
+    __slots__ = ("name", "last", "times", "values")
+
+
+    def __init__(self, name, size):
+        self.name = name
+        self.last = 0                       # secuencia de la última muestra (0 = ninguna)
+        self.times = array("q", [0]) * size
+        self.values = array("q", [0]) * size
+
+
+
+
+class HistoryTable(MibTable):
+    """historyTable: un HistoryRing por métrica, con índice (métrica, secuencia).
+
+    Las filas no se guardan en ningún sitio: las de la métrica m son sus últimas size
+    secuencias, así que añadir una muestra escribe dos posiciones (O(1), memoria
+    constante) y GETNEXT/GETBULK calculan la fila siguiente en vez de buscarla.
+    """
+
+    def __init__(self, name, entry_oid, columns, index_names=(), persistent=False, size=HISTORY_SIZE):
+        super().__init__(name, entry_oid, columns, index_names, persistent)
+        self.size = size
+        self.rings = {}   # número de métrica -> HistoryRing
+        self.ids = []     # números de métrica en orden
+
+
+    def add_metric(self, metric, name):
+        self.rings[metric] = HistoryRing(name, self.size)
+        insort(self.ids, metric)
+
+
+    def append(self, metric, stamp, value):
+        ring = self.rings[metric]
+        ring.last += 1
+        pos = (ring.last - 1) % self.size
+        ring.times[pos] = stamp
+        ring.values[pos] = value
+
+
+    def dump(self):
+        return {metric: (ring.last, ring.times, ring.values) for metric, ring in self.rings.items()}
+
+
+    def restore(self, state):
+        for metric, (last, times, values) in state.items():
+            ring = self.rings[metric]
+            ring.last, ring.times, ring.values = last, times, values
+
+
+    def _bounds(self, metric):
+        last = self.rings[metric].last
+        return max(1, last - self.size + 1), last
+
+
+    def __len__(self):
+        return sum(min(r.last, self.size) for r in self.rings.values())
+
+
+    def has_row(self, index):
+        if len(index) != 2 or index[0] not in self.rings:
+            return False
+        lo, hi = self._bounds(index[0])
+        return lo <= index[1] <= hi
+
+
+    def cell_value(self, subid, index):
+        pos = self._index_cols.get(subid)
+        if pos is not None:
+            return index[pos]
+        ring = self.rings[index[0]]
+        name = self.columns[subid].name
+        if name == "historyMetricName":
+            return ring.name
+        return (ring.times if name == "historyTime" else ring.values)[(index[1] - 1) % self.size]
+
+
+    def first_row(self):
+        return self.row_after(())
+
+
+    def row_after(self, index):
+        for metric in self.ids[bisect_left(self.ids, index[0]) if index else 0:]:
+            lo, hi = self._bounds(metric)
+            seq = max(lo, index[1] + 1) if len(index) > 1 and index[0] == metric else lo
+            if seq <= hi:
+                return metric, seq
+        return None
+
+
+
+
+# tablas con almacenamiento propio (el resto son MibTable)
+TABLE_TYPES = {"historyTable": HistoryTable}
+
+
+
+
+class MibRegistry:
+    """Escalares por OID (tupla) y tablas, con índice ordenado para GETNEXT/GETBULK."""
+
+    def __init__(self):
+        self.objects = {}
+        self.by_name = {}
+        self.index = OidIndex()
+        self.tables = []
+        self.tables_by_name = {}
+
+
+    def add(self, obj: ManagedObject):
+        self.objects[obj.key] = obj
+        self.by_name[obj.name] = obj
+        self.index.add(obj.oid)
+
+
+    def add_table(self, table: MibTable):
+        self.tables.append(table)
+        self.tables.sort(key=lambda t: t.entry)
+        self.tables_by_name[table.name] = table
+
+
+    def remove(self, oid):
+        obj = self.objects.pop(oid_to_tuple(oid), None)
+        if obj is not None:
+            self.by_name.pop(obj.name, None)
+            self.index.remove(obj.oid)
+
+
+    def get(self, oid):
+        # un ObjectIdentifier de pysnmp tiene el mismo hash que su tupla
+        return self.objects.get(oid_to_tuple(oid) if isinstance(oid, str) else oid)
+
+
+    def find_cell(self, oid):
+        key = oid_to_tuple(oid)
+        for table in self.tables:
+            cell = table.split(key)
+            if cell is not None:
+                return table, cell[0], cell[1]
+        return None
+
+
+    def access_key(self, oid):
+        """Clave del objeto al que pertenece oid para el control de acceso: el OID de la
+        instancia si es un escalar, el de la columna si es una celda; None si no existe."""
+        obj = self.get(oid)
+        if obj is not None:
+            return obj.key
+        cell = self.find_cell(oid) if self.tables else None
+        if cell is not None:
+            return cell[0].entry + (cell[1],)
+        return None
+
+
+    def get_varbind(self, oid, view=None):
+        """Varbind de oid, o None si no existe o (con view) quien pregunta no puede leerlo."""
+        obj = self.get(oid)
+        if obj is not None:
+            return obj.varbind() if view is None or view.readable(obj.key) else None
+        cell = self.find_cell(oid) if self.tables else None
+        if cell is not None:
+            table, subid, index = cell
+            if table.has_row(index) and table.columns[subid].readable and \
+                    (view is None or view.readable(table.entry + (subid,))):
+                return table.varbind(subid, index)
+        return None
+
+
+    def next(self, oid, view=None):
+        """(OID, varbind) del siguiente objeto instanciado en orden lexicográfico, o None.
+
+        Con view se salta lo que quien pregunta no puede leer; una columna denegada se
+        salta entera, sin recorrer sus filas.
+        """
+        key = oid_to_tuple(oid)
+        while True:
+            nxt = self.index.next(key)
+            best = nxt[0] if nxt else None
+            best_cell = None
+            for table in self.tables:
+                cell = table.next_cell(key)
+                if cell is not None:
+                    cell_key = table.cell_oid(*cell)
+                    if best is None or cell_key < best:
+                        best, best_cell = cell_key, (table, cell)
+            if best is None:
+                return None
+            if best_cell is None:
+                if view is None or view.readable(best):
+                    return best, self.objects[best].varbind()
+                key = best
+                continue
+            table, (subid, index) = best_cell
+            column = table.entry + (subid,)
+            if view is None or view.readable(column):
+                return best, table.varbind(subid, index)
+            key = column + (PAST_LAST_SUBID,)
+
+
+    def varbind_size(self, key, vb):
+        obj = self.objects.get(key)
+        return obj.varbind_size() if obj is not None else varbind_size(vb)
+
+
+    def __getitem__(self, name) -> ManagedObject:
+        return self.by_name[name]
+
+
+    def entry(self, oid):
+        obj = self.get(oid)
+        if obj is not None:
+            return (obj.syntax, obj.value)
+        cell = self.find_cell(oid)
+        if cell is not None:
+            table, subid, index = cell
+            if table.has_row(index):
+                return (table.columns[subid].syntax, table.cell_value(subid, index))
+        return None
+
+
+    def load(self, state):
+        for oid, (syntax, value) in state.items():
+            obj = self.get(oid)
+            if obj is not None:
+                if obj.syntax == syntax:
+                    obj.value = value
+                continue
+            cell = self.find_cell(oid)
+            if cell is not None and cell[0].persistent and cell[1] in cell[0].persisted:
+                table, subid, index = cell
+                table.add_row(index)
+                table._data[subid][table._pos[index]] = value
+                table.version += 1
+
+
+    def update(self, name, value):
+        """Cambia el valor de un objeto (SET o monitor) y lo marca para persistir."""
+        obj = self.by_name[name]
+        obj.set(value)
+        STATE_WRITER.mark_dirty(obj.oid)
+
+
+    def update_many(self, values):
+        """update() de varios objetos de una vez; los que no cambian conservan su varbind en caché."""
+        by_name = self.by_name
+        for name, value in values.items():
+            obj = by_name[name]
+            if obj.value != value:
+                obj.set(value)
+                STATE_WRITER.mark_dirty(obj.oid)
+
+
+    def _mark_row(self, table, index):
+        if table.persistent:
+            for subid in table.persisted:
+                STATE_WRITER.mark_dirty(".".join(map(str, table.cell_oid(subid, index))))
+
+
+    def apply_cell(self, table, subid, index, value):
+        """Aplica un SET ya validado sobre una celda (crear/destruir fila vía RowStatus)."""
+        if subid == table.row_status and value in (CREATE_AND_GO, CREATE_AND_WAIT):
+            table.add_row(index)
+            value = ACTIVE if value == CREATE_AND_GO else NOT_IN_SERVICE
+        elif subid == table.row_status and value == DESTROY:
+            self._mark_row(table, index)
+            table.remove_row(index)
+            return
+        table._data[subid][table._pos[index]] = value
+        table.version += 1
+        if table.persistent and subid in table.persisted:
+            STATE_WRITER.mark_dirty(".".join(map(str, table.cell_oid(subid, index))))
+        if subid == table.row_status:
+            self._mark_row(table, index)
+
+
+    def dump_tables(self):
+        """Contenido de las tablas (la estructura ya la tiene quien lo lee; los escalares van en STORE)."""
+        return {table.name: table.dump() for table in self.tables}
+
+
+    def tables_version(self):
+        """Crece con cualquier cambio en cualquier tabla (cada MibTable.version sólo sube)."""
+        return sum(table.version for table in self.tables)
+
+
+    def restore_tables(self, state):
+        for table in self.tables:
+            table.restore(state[table.name])
+
+
+    def invalidate_all(self):
+        for obj in self.objects.values():
+            obj._vb = None
+            obj._size = None
+
+
+
+
+def build_registry(mib):
+    """Un ManagedObject por cada escalar accesible de la MIB compilada."""
+    registry = MibRegistry()
+    for name, d in mib.items():
+        if d["kind"] != "OBJECT-TYPE" or d["access"] not in ("read-only", "read-write"):
+            continue
+        if d["syntax"] not in SYNTAXES or mib.get(d["parent"], {}).get("kind") == "OBJECT-TYPE":
+            continue   # columnas de tablas (se registran con su tabla) y tipos no soportados
+        oid = ".".join(map(str, d["oid"] + [0]))
+        value = DEFAULT_STORE.get(oid, (None, d.get("defval")))[1]
+        registry.add(ManagedObject(oid, name, d["syntax"], d["access"], d["constraints"], value))
+
+    # tablas: SEQUENCE OF -> entrada (INDEX) -> columnas
+    for name, d in mib.items():
+        if d["kind"] != "OBJECT-TYPE" or d["syntax"] != "SEQUENCE":
+            continue
+        entry_name = next(n for n, e in mib.items() if e.get("parent") == name)
+        entry = mib[entry_name]
+        columns = [Column(c["oid"][-1], n, c["syntax"], c["access"], c["constraints"], c.get("defval"))
+                   for n, c in mib.items() if c.get("parent") == entry_name]
+        persistent = any(c.access == "read-create" for c in columns)
+        table_type = TABLE_TYPES.get(name, MibTable)
+        registry.add_table(table_type(name, entry["oid"], columns, entry.get("index", ()), persistent))
+    return registry
+
+
+
+
+REGISTRY = build_registry(MIB)
+# objetos que no se escriben en disco salvo PERSIST_VOLATILE, sacados de la MIB compilada
+VOLATILE_OIDS = {obj.oid for obj in REGISTRY.objects.values()
+                 if obj.access == "read-only" and obj.name not in PERSISTENT_READ_ONLY}
+REGISTRY.load(load_state())
+STATE_WRITER = StateWriter(REGISTRY, BACKEND)
+
+
+
+# --------------------------------------------------------------------
+# CONTROL DE ACCESO (decisiones de VACM precalculadas por principal y objeto)
+# --------------------------------------------------------------------
+class AccessView:
+    """Lo que puede leer y escribir un principal (modelo, securityName, nivel, contexto).
+
+    Cada decisión se pide una sola vez a VACM y queda en un diccionario por objeto
+    (escalar o columna), así que comprobar un varbind es una consulta O(1). Lo que VACM
+    no permite, o no sabe resolver, queda denegado.
+    """
+
+    __slots__ = ("principal", "read", "write")
+
+    def __init__(self, principal):
+        self.principal = principal
+        self.read = {}    # clave de objeto (REGISTRY.access_key) -> bool
+        self.write = {}
+
+
+    def readable(self, key):
+        allowed = self.read.get(key)
+        if allowed is None:
+            allowed = self.read[key] = ACCESS.allowed(self.principal, "read", key)
+        return allowed
+
+
+    def writable(self, key):
+        allowed = self.write.get(key)
+        if allowed is None:
+            allowed = self.write[key] = ACCESS.allowed(self.principal, "write", key)
+        return allowed
+
+
+    def prepare(self, keys):
+        for key in keys:
+            self.readable(key)
+            self.writable(key)
+
+
+
+
+class AccessControl:
+    """Vistas por principal, resueltas una vez por mensaje en los handlers (processPdu)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.views = {}
+
+
+    def view(self, securityModel, securityName, securityLevel, contextName) -> AccessView:
+        principal = (int(securityModel), bytes(securityName), int(securityLevel), bytes(contextName))
+        view = self.views.get(principal)
+        if view is None:
+            view = self.views[principal] = AccessView(principal)
+        return view
+
+
+    def allowed(self, principal, view_type, key):
+        model, name, level, context = principal
+        try:
+            # VACM lanza (o devuelve) StatusInformation si el objeto no está en la vista
+            return self.engine.accessControlModel[3].isAccessAllowed(
+                self.engine, model, v2c.OctetString(name), level, view_type,
+                v2c.OctetString(context), v2c.ObjectIdentifier(key)) is None
+        except error.StatusInformation:
+            return False
+
+
+    def prepare(self, registry):
+        """Precalcula las decisiones de los principales configurados sobre todos los objetos."""
+        keys = list(registry.objects)
+        keys += [table.entry + (subid,) for table in registry.tables for subid in table.columns]
+        principals = [(model, name, 1) for name in SECURITY_NAMES
+                      if name not in V3_NAMES for model in (1, 2)]
+        principals += [(3, name, 3) for name in V3_NAMES]
+        for model, name, level in principals:
+            self.view(model, name.encode("utf-8"), level, b"").prepare(keys)
+
+
+
+
+PAST_LAST_SUBID = 2 ** 32          # mayor que cualquier subidentificador: salta un subárbol entero
+V3_NAMES = {user["user"] for user in V3_USERS}
+ACCESS = AccessControl(snmp_engine)
+
+
+
+
+class AccessControlledResponder:
+    """Mezcla para los handlers: la vista de quien pregunta se resuelve una vez por mensaje."""
+
+    _view = None
+
+
+    def processPdu(self, snmpEngine, messageProcessingModel, securityModel, securityName,
+                   securityLevel, contextEngineId, contextName, pduVersion, PDU,
+                   maxSizeResponseScopedPDU, stateReference):
+        self._view = ACCESS.view(securityModel, securityName, securityLevel, contextName)
+        super().processPdu(
+            snmpEngine, messageProcessingModel, securityModel, securityName,
+            securityLevel, contextEngineId, contextName, pduVersion, PDU,
+            maxSizeResponseScopedPDU, stateReference)
+
+
+# --------------------------------------------------------------------
+# HANDLERS SNMP (GET / GETNEXT / GETBULK / SET)
+# --------------------------------------------------------------------
+class MiniGet(AccessControlledResponder, cmdrsp.GetCommandResponder):
+    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
+        req = v2c.apiPDU.getVarBinds(PDU)
+        view = self._view
+        rsp = []
+        for oid, _ in req:
+            vb = REGISTRY.get_varbind(oid, view)
+            rsp.append(vb if vb is not None else (oid, v2c.NoSuchObject()))
+        rsp_pdu = v2c.apiPDU.getResponse(PDU)
+        set_varbinds(rsp_pdu, rsp)
+        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
+
+
+
+
+class MiniGetNext(AccessControlledResponder, cmdrsp.NextCommandResponder):
+    _v1 = False
+
+
+    def processPdu(self, snmpEngine, messageProcessingModel, securityModel, securityName,
+                   securityLevel, contextEngineId, contextName, pduVersion, PDU,
+                   maxSizeResponseScopedPDU, stateReference):
+        # SNMPv1 no tiene Counter64: su GETNEXT se los salta (RFC 2576, 4.1.2.1)
+        self._v1 = messageProcessingModel == 0
+        super().processPdu(
+            snmpEngine, messageProcessingModel, securityModel, securityName,
+            securityLevel, contextEngineId, contextName, pduVersion, PDU,
+            maxSizeResponseScopedPDU, stateReference)
+
+
+    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
+        req = v2c.apiPDU.getVarBinds(PDU)
+        view = self._view
+        rsp = []
+        for oid, _ in req:
+            nxt = REGISTRY.next(oid, view)
+            while self._v1 and nxt and v2c.apiVarBind.getOIDVal(nxt[1])[1].tagSet == v2c.Counter64.tagSet:
+                nxt = REGISTRY.next(nxt[0], view)
+            rsp.append(nxt[1] if nxt else (oid, v2c.EndOfMibView()))
+        rsp_pdu = v2c.apiPDU.getResponse(PDU)
+        set_varbinds(rsp_pdu, rsp)
+        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
+
+
+
+
+class MiniGetBulk(AccessControlledResponder, cmdrsp.BulkCommandResponder):
+    # bytes reservados para la cabecera del mensaje (versión, comunidad, request-id...)
+    RESPONSE_OVERHEAD = 64
+
+
+    def processPdu(self, snmpEngine, messageProcessingModel, securityModel, securityName,
+                   securityLevel, contextEngineId, contextName, pduVersion, PDU,
+                   maxSizeResponseScopedPDU, stateReference):
+        # guardamos el tamaño máximo de respuesta que admite el gestor para este mensaje
+        self._max_size = maxSizeResponseScopedPDU
+        super().processPdu(
+            snmpEngine, messageProcessingModel, securityModel, securityName,
+            securityLevel, contextEngineId, contextName, pduVersion, PDU,
+            maxSizeResponseScopedPDU, stateReference)
+
+
+    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
+        req = v2c.apiPDU.getVarBinds(PDU)
+        non_rep = max(int(v2c.apiBulkPDU.getNonRepeaters(PDU)), 0)
+        max_rep = max(int(v2c.apiBulkPDU.getMaxRepetitions(PDU)), 0)
+
+        N = min(non_rep, len(req))
+        R = len(req) - N
+        budget = int(getattr(self, "_max_size", 65507)) - self.RESPONSE_OVERHEAD
+        view = self._view
+        rsp = []
+
+
+        def append(nxt, oid):
+            # nxt None -> endOfMibView para el último OID alcanzado
+            nonlocal budget
+            if nxt is not None:
+                vb = nxt[1]
+                size = REGISTRY.varbind_size(nxt[0], vb)
+            else:
+                vb = (v2c.ObjectIdentifier(oid), v2c.EndOfMibView())
+                size = varbind_size(vb)
+            if size > budget:
+                return False
+            budget -= size
+            rsp.append(vb)
+            return True
+
+
+        # non-repeaters: un único GETNEXT por varbind
+        for oid, _ in req[:N]:
+            if not append(REGISTRY.next(oid, view), oid):
+                break
+        else:
+            # repeaters: hasta max-repetitions filas mientras quepan en el mensaje
+            cursors = [oid for oid, _ in req[N:]]
+            ended = [False] * R
+            full = False
+            for _ in range(max_rep if R else 0):
+                if all(ended):
+                    break
+                for i, oid in enumerate(cursors):
+                    nxt = None if ended[i] else REGISTRY.next(oid, view)
+                    if nxt is not None:
+                        cursors[i] = nxt[0]
+                    else:
+                        ended[i] = True
+                    if not append(nxt, oid):
+                        full = True
+                        break
+                if full:
+                    break
+
+        rsp_pdu = v2c.apiPDU.getResponse(PDU)
+        set_varbinds(rsp_pdu, rsp)
+        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
+
+
+
+
+def set_error_response(rsp_pdu, req, status, idx):
+    v2c.apiPDU.setErrorStatus(rsp_pdu, status)
+    v2c.apiPDU.setErrorIndex(rsp_pdu, idx)
+    v2c.apiPDU.setVarBinds(rsp_pdu, req)
+    return rsp_pdu
+
+
+
+
+def apply_set(PDU):
+    """Valida y aplica un SetRequest ya autorizado; devuelve el PDU de respuesta.
+
+    Sólo se ejecuta en el proceso que tiene el registro: con workers, éstos reenvían
+    aquí sus SET (ver MODO MULTIPROCESO).
+    """
+    # --- Validaciones: una consulta al registro por varbind ---
+    req = v2c.apiPDU.getVarBinds(PDU)
+    rsp_pdu = v2c.apiPDU.getResponse(PDU)
+    scalars = []
+    cells = []
+    creating = {}   # (tabla, índice) -> createAndGo/createAndWait pedidos en este PDU
+    orphans = {}    # (tabla, índice) -> posición de la primera celda sin fila
+
+
+    for idx, (oid, val) in enumerate(req, start=1):
+        obj = REGISTRY.get(oid)
+        cell = REGISTRY.find_cell(oid) if obj is None else None
+        if obj is not None:
+            status = 17 if not obj.writable else obj.validate(val)
+            if not status:
+                scalars.append((obj, obj.decode(val)))
+        elif cell is not None:
+            table, subid, index = cell
+            status = table.check_set(subid, index, val, creating, orphans, idx)
+            if not status:
+                cells.append((table, subid, index, table.columns[subid].decode(val)))
+        else:
+            status = 6      # noAccess
+        if status:
+            return set_error_response(rsp_pdu, req, status, idx)
+
+
+    for row, idx in orphans.items():
+        if row not in creating:
+            return set_error_response(rsp_pdu, req, 11, idx)   # noCreation
+
+
+    # --- Aplicar: escalares, altas de filas, resto de celdas y por último bajas ---
+    for obj, value in scalars:
+        REGISTRY.update(obj.name, value)
+
+
+    def phase(cell):
+        table, subid, _, value = cell
+        if subid == table.row_status:
+            return 0 if value in (CREATE_AND_GO, CREATE_AND_WAIT) else 2
+        return 1
+
+
+    changed = set()
+    for table, subid, index, value in sorted(cells, key=phase):
+        REGISTRY.apply_cell(table, subid, index, value)
+        changed.add(table)
+    for table in changed:
+        if table.on_change:
+            table.on_change(table)
+
+
+    rsp_varbinds = []
+    for oid, val in req:
+        obj = REGISTRY.get(oid)
+        rsp_varbinds.append(obj.varbind() if obj is not None else (oid, val))
+
+
+    v2c.apiPDU.setErrorStatus(rsp_pdu, 0)
+    v2c.apiPDU.setErrorIndex(rsp_pdu, 0)
+    set_varbinds(rsp_pdu, rsp_varbinds)
+    return rsp_pdu
+
+
+
+
+class MiniSet(AccessControlledResponder, cmdrsp.SetCommandResponder):
+    def __init__(self, *args, **kwargs):
+        cmdrsp.SetCommandResponder.__init__(self, *args, **kwargs)
+        self._forwarded = set()   # SET reenviados al propietario que aún esperan respuesta
+
+
+    def releaseStateInformation(self, stateReference):
+        # processPdu la libera al volver de handleMgmtOperation; la de un SET reenviado
+        # hace falta hasta que llegue su respuesta
+        if stateReference not in self._forwarded:
+            cmdrsp.SetCommandResponder.releaseStateInformation(self, stateReference)
+
+
+    def _reply_forwarded(self, snmpEngine, stateReference, rsp_pdu):
+        self._forwarded.discard(stateReference)
+        self.sendPdu(snmpEngine, stateReference, rsp_pdu)
+        self.releaseStateInformation(stateReference)
+
+
+    def handleMgmtOperation(self, snmpEngine, stateReference, contextName, PDU):
+        # --- Vista de escritura de quien pregunta (los OID inexistentes los rechaza apply_set) ---
+        req = v2c.apiPDU.getVarBinds(PDU)
+        view = self._view
+        for idx, (oid, _) in enumerate(req, start=1):
+            key = REGISTRY.access_key(oid)
+            if key is not None and not view.writable(key):
+                self.sendPdu(snmpEngine, stateReference,
+                             set_error_response(v2c.apiPDU.getResponse(PDU), req, 17, idx))
+                print(f"[DENEGADO] SET de {oid.prettyPrint()} rechazado para "
+                      f"'{view.principal[1].decode('utf-8', 'replace')}' (fuera de su vista de escritura)")
+                return
+
+
+        if SET_FORWARDER is not None:
+            # worker: el SET lo aplica el proceso propietario y la respuesta llega después
+            self._forwarded.add(stateReference)
+            SET_FORWARDER.forward(PDU, lambda rsp_pdu: self._reply_forwarded(snmpEngine, stateReference, rsp_pdu))
+            return
+        self.sendPdu(snmpEngine, stateReference, apply_set(PDU))
+
+
+
+
+SET_FORWARDER = None   # SetForwarder en los procesos worker (ver MODO MULTIPROCESO)
+
+MiniGet(snmp_engine, snmpContext)
+MiniGetNext(snmp_engine, snmpContext)
+MiniGetBulk(snmp_engine, snmpContext)
+MiniSet(snmp_engine, snmpContext)
+
+
+# --------------------------------------------------------------------
+# MUESTREO BAJO DEMANDA (caché con TTL por métrica)
+# --------------------------------------------------------------------
+CPU_SAMPLE_TTL = 1.0     # segundos que un valor de cpuUsage se da por bueno
+CORE_SAMPLE_TTL = 1.0    # ídem para cpuPerCoreTable
+EVAL_INTERVAL = 5.0      # periodo de evaluación de umbrales (independiente de los GET)
+
+
+
+
+class Sampler:
+    """Métrica muestreada bajo demanda y cacheada durante ttl segundos.
+
+    Un GET con el valor caducado responde con el último valor y programa un único
+    refresco en el bucle, por muchos GET que lleguen a la vez; quien evalúa umbrales
+    usa current(), que refresca en el momento si el valor ha caducado.
+    """
+
+    def __init__(self, sample, ttl, publish=None):
+        self.sample = sample      # función que lee la métrica (psutil)
+        self.ttl = ttl
+        self.publish = publish    # vuelca el valor en el registro
+        self.value = None
+        self.stamp = float("-inf")
+        self.refreshes = 0
+        self._pending = False
+
+
+    def fresh(self):
+        return time.monotonic() - self.stamp < self.ttl
+
+
+    def refresh(self):
+        try:
+            self.value = self.sample()
+            self.stamp = time.monotonic()
+            self.refreshes += 1
+            if self.publish:
+                self.publish(self.value)
+        finally:
+            self._pending = False
+        return self.value
+
+
+    def current(self):
+        return self.value if self.fresh() else self.refresh()
+
+
+    def touch(self):
+        """Llamado en cada lectura SNMP: programa el refresco si el valor ha caducado."""
+        if self._pending or self.fresh():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or self.value is None:
+            self.refresh()
+            return
+        self._pending = True
+        loop.call_soon(self.refresh)
+
+
+
+
+CORE_TABLE = REGISTRY.tables_by_name["cpuPerCoreTable"]
+
+
+
+
+def sample_cores():
+    """Una sola muestra de psutil para todos los núcleos, volcada columna a columna en la tabla."""
+    times = psutil.cpu_times_percent(interval=None, percpu=True)
+    if len(times) != len(CORE_TABLE):
+        CORE_TABLE.set_rows([(i + 1,) for i in range(len(times))])
+    idle = array("q", [int(t.idle) for t in times])
+    usage = array("q", [100 - v for v in idle])
+    CORE_TABLE.set_column("cpuCoreUsage", usage)
+    CORE_TABLE.set_column("cpuCoreUser", [int(t.user) for t in times])
+    CORE_TABLE.set_column("cpuCoreSystem", [int(t.system) for t in times])
+    CORE_TABLE.set_column("cpuCoreIdle", idle)
+    return usage
+
+
+
+
+CPU_SAMPLER = Sampler(lambda: int(psutil.cpu_percent(interval=None)), CPU_SAMPLE_TTL,
+                      lambda v: REGISTRY.update("cpuUsage", v))
+CORE_SAMPLER = Sampler(sample_cores, CORE_SAMPLE_TTL)
+# la primera lectura de psutil no tiene referencia: se hace aquí y se descarta, y la
+# primera consulta SNMP (sin valor aún en el Sampler) muestrea en el momento
+psutil.cpu_percent(interval=None)
+psutil.cpu_times_percent(interval=None, percpu=True)
+CORE_TABLE.set_rows([(i + 1,) for i in range(psutil.cpu_count())])
+REGISTRY["cpuUsage"].sampler = CPU_SAMPLER
+CORE_TABLE.sampler = CORE_SAMPLER
+
+
+
+
+# --------------------------------------------------------------------
+# RECOLECTORES DE MÉTRICAS (memoria, swap, disco, red) Y PLANIFICADOR
+# --------------------------------------------------------------------
+# recolector -> segundos entre muestras; los que comparten intervalo se muestrean juntos
+COLLECT_INTERVALS = {"memory": 5.0, "swap": 30.0, "disk": 5.0, "net": 5.0}
+
+
+
+
+def kb_rate(prev, cur, elapsed):
+    """KB/s entre dos lecturas de un contador (0 en la primera o si el contador ha retrocedido)."""
+    if prev is None or elapsed <= 0 or cur < prev:
+        return 0
+    return int((cur - prev) / elapsed / 1024)
+
+
+
+
+class Collector(abc.ABC):
+    """Plugin de recogida para el planificador.
+
+    collect() hace las llamadas bloqueantes (psutil) y se ejecuta fuera del bucle;
+    publish(raw, elapsed) se ejecuta en el bucle con lo leído y los segundos desde la
+    muestra anterior, y devuelve {objeto de la MIB: valor}. Un recolector al que le
+    falte alguno de los dos no se puede crear.
+    """
+
+    name = ""
+
+
+    @abc.abstractmethod
+    def collect(self):
+        ...
+
+
+    @abc.abstractmethod
+    def publish(self, raw, elapsed):
+        ...
+
+
+
+
+class MemoryCollector(Collector):
+    name = "memory"
+
+
+    def collect(self):
+        return psutil.virtual_memory()
+
+
+    def publish(self, mem, elapsed):
+        return {"memTotal": mem.total // 1024, "memAvailable": mem.available // 1024,
+                "memUsage": round(mem.percent)}
+
+
+
+
+class SwapCollector(Collector):
+    name = "swap"
+
+
+    def collect(self):
+        return psutil.swap_memory()
+
+
+    def publish(self, swap, elapsed):
+        return {"swapTotal": swap.total // 1024, "swapUsed": swap.used // 1024,
+                "swapUsage": round(swap.percent)}
+
+
+
+
+class DiskCollector(Collector):
+    name = "disk"
+
+
+    def __init__(self):
+        self.last = None
+
+
+    def collect(self):
+        return psutil.disk_io_counters()
+
+
+    def publish(self, io, elapsed):
+        if io is None:
+            return {}   # sin discos visibles (algunos contenedores)
+        last, self.last = self.last, io
+        return {"diskReadBytes": io.read_bytes, "diskWriteBytes": io.write_bytes,
+                "diskReadOps": io.read_count, "diskWriteOps": io.write_count,
+                "diskReadRate": kb_rate(last and last.read_bytes, io.read_bytes, elapsed),
+                "diskWriteRate": kb_rate(last and last.write_bytes, io.write_bytes, elapsed)}
+
+
+
+
+class NetCollector(Collector):
+    name = "net"
+
+
+    def __init__(self):
+        self.last = None
+
+
+    def collect(self):
+        return psutil.net_io_counters()
+
+
+    def publish(self, io, elapsed):
+        if io is None:
+            return {}
+        last, self.last = self.last, io
+        return {"netInOctets": io.bytes_recv, "netOutOctets": io.bytes_sent,
+                "netInPackets": io.packets_recv, "netOutPackets": io.packets_sent,
+                "netInErrors": io.errin, "netOutErrors": io.errout,
+                "netInRate": kb_rate(last and last.bytes_recv, io.bytes_recv, elapsed),
+                "netOutRate": kb_rate(last and last.bytes_sent, io.bytes_sent, elapsed)}
+
+
+
+
+class CollectorScheduler:
+    """Un único planificador para todos los recolectores.
+
+    Los recolectores con el mismo intervalo forman un grupo y una sola tarea: en cada
+    tick sus collect() van juntos en una única llamada al executor (un salto de hilo por
+    tick, no por métrica) y lo que devuelven sus publish() entra en el registro con un
+    solo update_many. Los ticks siguen una rejilla fija (inicio + k * intervalo): un
+    tick lento no retrasa los siguientes ni provoca una ráfaga para recuperarlos.
+    """
+
+    def __init__(self):
+        self.groups = {}   # intervalo -> [Collector]
+        self.last = {}     # intervalo -> instante (monotonic) de la última muestra
+        self.ticks = 0
+        self.errors = 0
+
+
+    def register(self, collector, interval):
+        self.groups.setdefault(interval, []).append(collector)
+
+
+    @staticmethod
+    def _collect(collectors):
+        # en el hilo del executor: un recolector que falla no impide leer los demás
+        results = []
+        for collector in collectors:
+            try:
+                results.append(collector.collect())
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+    def publish(self, interval, results, now):
+        last = self.last.get(interval)
+        self.last[interval] = now
+        elapsed = now - last if last is not None else 0.0
+        values = {}
+        for collector, raw in zip(self.groups[interval], results):
+            if isinstance(raw, Exception):
+                self.errors += 1
+                print(f"[ERROR] Recolector {collector.name}: {raw}")
+                continue
+            values.update(collector.publish(raw, elapsed))
+        REGISTRY.update_many(values)
+        self.ticks += 1
+        return values
+
+
+    def collect_now(self):
+        """Un tick de todos los grupos en el momento (al arrancar, para no servir ceros)."""
+        for interval, collectors in self.groups.items():
+            self.publish(interval, self._collect(collectors), time.monotonic())
+
+
+    async def run_group(self, interval):
+        loop = asyncio.get_running_loop()
+        collectors = self.groups[interval]
+        start = loop.time()
+        k = 0
+        while True:
+            k += 1
+            await asyncio.sleep(max(0.0, start + k * interval - loop.time()))
+            results = await loop.run_in_executor(None, self._collect, collectors)
+            self.publish(interval, results, time.monotonic())
+            k = max(k, int((loop.time() - start) / interval))
+
+
+    async def run(self):
+        await asyncio.gather(*(self.run_group(interval) for interval in sorted(self.groups)))
+
+
+
+
+COLLECTORS = [MemoryCollector(), SwapCollector(), DiskCollector(), NetCollector()]
+SCHEDULER = CollectorScheduler()
+for _collector in COLLECTORS:
+    SCHEDULER.register(_collector, COLLECT_INTERVALS.get(_collector.name, EVAL_INTERVAL))
+SCHEDULER.collect_now()
+
+
+
+
+# --------------------------------------------------------------------
+# HISTÓRICO DE MÉTRICAS (historyTable)
+# --------------------------------------------------------------------
+HISTORY_METRICS = ["cpuUsage"]   # objetos de la MIB que se guardan; historyMetric = posición (desde 1)
+HISTORY = REGISTRY.tables_by_name["historyTable"]
+for _metric, _name in enumerate(HISTORY_METRICS, 1):
+    HISTORY.add_metric(_metric, _name)
+
+
+
+
+def record_history(stamp=None):
+    """Añade a historyTable el valor actual de cada métrica de HISTORY_METRICS."""
+    stamp = int(time.time()) if stamp is None else stamp
+    for metric, name in enumerate(HISTORY_METRICS, 1):
+        HISTORY.append(metric, stamp, int(REGISTRY[name].value))
+
+
+
+
+# --------------------------------------------------------------------
+# AGREGADOS EN VENTANA DESLIZANTE (cpuAvg*, cpuMin*, cpuMax*, cpuPctl*)
+# --------------------------------------------------------------------
+CPU_WINDOWS = {"1m": 60, "5m": 300, "15m": 900}   # sufijo de los escalares de la MIB -> segundos
+
+
+
+
+class SlidingWindow:
+    """Agregados de las últimas size muestras enteras, en O(1) amortizado por muestra.
+
+    La media sale de una suma acumulada; el mínimo y el máximo, de dos deques monótonas
+    de (secuencia, valor); los percentiles, de un histograma de 101 cubetas que hace de
+    resumen exacto para porcentajes enteros (fuera de 0..100 los valores cuentan en la
+    cubeta del extremo). Un cursor sobre el histograma guarda cuántas muestras quedan por
+    debajo de su cubeta; add() lo mantiene y percentile() sólo lo desplaza lo que se haya
+    movido el rango desde la consulta anterior, sin reacumular las 101 cubetas.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.samples = deque()
+        self.seq = 0
+        self.total = 0
+        self.mins = deque()   # valores crecientes: el primero es el mínimo
+        self.maxs = deque()   # valores decrecientes: el primero es el máximo
+        self.hist = array("q", [0]) * 101
+        self.cursor = 0       # cubeta del último percentil consultado
+        self.below = 0        # muestras en las cubetas por debajo del cursor
+
+
+    def __len__(self):
+        return len(self.samples)
+
+
+    def add(self, value):
+        value = int(value)
+        self.seq += 1
+        self.samples.append(value)
+        self.total += value
+        bucket = min(100, max(0, value))
+        self.hist[bucket] += 1
+        if bucket < self.cursor:
+            self.below += 1
+        if len(self.samples) > self.size:
+            old = self.samples.popleft()
+            self.total -= old
+            bucket = min(100, max(0, old))
+            self.hist[bucket] -= 1
+            if bucket < self.cursor:
+                self.below -= 1
+        oldest = self.seq - len(self.samples) + 1
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((self.seq, value))
+        if self.mins[0][0] < oldest:
+            self.mins.popleft()
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((self.seq, value))
+        if self.maxs[0][0] < oldest:
+            self.maxs.popleft()
+
+
+    def avg(self):
+        return round(self.total / len(self.samples)) if self.samples else 0
+
+
+    def min(self):
+        return self.mins[0][1] if self.mins else 0
+
+
+    def max(self):
+        return self.maxs[0][1] if self.maxs else 0
+
+
+    def percentile(self, p):
+        """Percentil p por rango más cercano."""
+        if not self.samples:
+            return 0
+        rank = max(1, -(-p * len(self.samples) // 100))
+        hist, cursor, below = self.hist, self.cursor, self.below
+        # primera cubeta cuyo acumulado llega a rank
+        while below + hist[cursor] < rank:
+            below += hist[cursor]
+            cursor += 1
+        while below >= rank:
+            cursor -= 1
+            below -= hist[cursor]
+        self.cursor, self.below = cursor, below
+        return cursor
+
+
+
+
+class WindowAggregates:
+    """Una SlidingWindow por ventana de CPU_WINDOWS; publica sus agregados en la MIB."""
+
+    def __init__(self, prefix, windows, interval):
+        self.prefix = prefix
+        self.windows = {suffix: SlidingWindow(max(1, round(seconds / interval)))
+                        for suffix, seconds in windows.items()}
+
+
+    def add(self, value):
+        p = int(REGISTRY[f"{self.prefix}WindowPercentile"].value)
+        for suffix, window in self.windows.items():
+            window.add(value)
+            REGISTRY.update(f"{self.prefix}Avg{suffix}", window.avg())
+            REGISTRY.update(f"{self.prefix}Min{suffix}", window.min())
+            REGISTRY.update(f"{self.prefix}Max{suffix}", window.max())
+            REGISTRY.update(f"{self.prefix}Pctl{suffix}", window.percentile(p))
+
+
+
+
+CPU_AGGREGATES = WindowAggregates("cpu", CPU_WINDOWS, EVAL_INTERVAL)
+# cpuTriggerSource: número -> escalar comparado con los umbrales (instant -> cpuUsage, avg5m -> cpuAvg5m...)
+TRIGGER_SOURCES = {num: "cpuUsage" if name == "instant" else "cpu" + name[0].upper() + name[1:]
+                   for name, num in MIB["cpuTriggerSource"]["enums"].items()}
+
+
+
+
+def trigger_value(cpu):
+    """(valor, escalar) que decide la alarma de CPU según cpuTriggerSource; cpu es la muestra."""
+    name = TRIGGER_SOURCES.get(int(REGISTRY["cpuTriggerSource"].value), "cpuUsage")
+    return (cpu if name == "cpuUsage" else int(REGISTRY[name].value)), name
+
+
+
+
+# --------------------------------------------------------------------
+# NOTIFICACIONES (emitidas en el propio bucle de eventos)
+# --------------------------------------------------------------------
+# Destinos de notificaciones. Cada uno: dirección, "trap" o "inform", versión (1 o 2 = v2c),
+# comunidad y etiquetas (grupos de destinos a los que se envía cada notificación)
+NOTIFICATION_TARGETS = [
+    {"name": "trap-dest-localhost", "address": ("127.0.0.1", 162), "type": "trap",
+     "version": 2, "community": "public", "tags": ("all-traps",)},
+    # {"name": "nms-backup", "address": ("192.168.10.20", 162), "type": "inform",
+    #  "version": 2, "community": "public", "tags": ("all-traps",)},
+    # {"name": "log-collector", "address": ("192.168.10.30", 162), "type": "trap",
+    #  "version": 1, "community": "logs", "tags": ("all-traps", "log")},
+]
+DEFAULT_NOTIFY_TAG = "all-traps"
+INFORM_TIMEOUT = 1.5          # segundos de espera de la respuesta a un INFORM
+INFORM_RETRIES = 4            # reintentos propios (los de pysnmp quedan a 0)
+INFORM_BACKOFF = 1.0          # espera antes del primer reintento; se duplica en cada uno
+INFORM_BACKOFF_MAX = 30.0
+INFORM_QUEUE_SIZE = 256       # INFORM pendientes por destino (en vuelo + en espera)
+INFORM_MAX_IN_FLIGHT = 8      # INFORM sin confirmar a la vez por destino
+
+SNMP_TRAP_OID = "1.3.6.1.6.3.1.1.4.1.0"
+NTF_ORG = ntforg.NotificationOriginator()
+
+
+
+
+class NotificationTemplate:
+    """Varbinds de una NOTIFICATION-TYPE de la MIB preparados una sola vez.
+
+    snmpTrapOID y los objetos de OBJECTS se resuelven al crearla; en cada envío sólo
+    se recogen los varbinds (cacheados) de esos objetos en el registro.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.head = (v2c.ObjectIdentifier(SNMP_TRAP_OID), v2c.ObjectIdentifier(tuple(MIB[name]["oid"])))
+        self.objects = [REGISTRY[obj] for obj in MIB[name]["objects"]]
+
+
+    def varbinds(self):
+        varBinds = [self.head]
+        varBinds.extend(v2c.apiVarBind.getOIDVal(obj.varbind()) for obj in self.objects)
+        return varBinds
+
+
+
+
+NOTIFICATIONS = {name: NotificationTemplate(name) for name, d in MIB.items() if d["kind"] == "NOTIFICATION-TYPE"}
+
+
+
+
+class NotificationTarget:
+    """Destino de notificaciones: trap (sin confirmar) o INFORM (confirmado).
+
+    Cada destino tiene su propia entrada de notificación y su etiqueta en el motor,
+    así que se le envía por separado. Traps (v1 y v2c) e INFORM salen por el mismo
+    NTF_ORG: pasan por la vista de notificación del destino, cuentan en el motor y van
+    por el transporte de su dirección. Los INFORM no usan los reintentos de pysnmp:
+    pasan por una cola propia con como mucho INFORM_MAX_IN_FLIGHT sin confirmar,
+    reintento con espera exponencial y descarte (contado) cuando la cola está llena
+    o se agotan los reintentos. Nada de esto espera: el monitor nunca se bloquea.
+    """
+
+    def __init__(self, name, kind="trap", tags=(DEFAULT_NOTIFY_TAG,), address=None, version=2, community="public"):
+        self.name = name
+        self.kind = kind
+        self.address = address
+        self.version = version
+        self.community = community
+        self.tags = frozenset(tags)
+        self.queue = deque()   # (varBinds, intento) listos para salir
+        self.in_flight = 0
+        self.waiting = 0       # esperando su reintento
+
+
+    @property
+    def pending(self):
+        return len(self.queue) + self.in_flight + self.waiting
+
+
+    def send(self, varBinds):
+        if self.kind == "trap":
+            if NTF_ORG.sendVarBinds(snmp_engine, self.name, None, b"", varBinds) is None:
+                raise RuntimeError(f"la VACM no permite notificar a {self.name}")
+            return
+        if self.pending >= INFORM_QUEUE_SIZE:
+            INFORM_STATS.count("notifInformsDropped")
+            print(f"[ERROR] Cola de INFORM de {self.name} llena: notificación descartada")
+            return
+        self.queue.append((varBinds, 0))
+        self._pump()
+
+
+    def _pump(self):
+        while self.queue and self.in_flight < INFORM_MAX_IN_FLIGHT:
+            varBinds, attempt = self.queue.popleft()
+            self.in_flight += 1
+            if NTF_ORG.sendVarBinds(snmp_engine, self.name, None, b"", varBinds,
+                                    self._done, (varBinds, attempt)) is None:
+                self.in_flight -= 1
+                INFORM_STATS.count("notifInformsDropped")
+        INFORM_STATS.refresh_pending()
+
+
+    def _done(self, snmpEngine, handle, errorIndication, errorStatus, errorIndex, varBinds, cbCtx):
+        varBinds, attempt = cbCtx
+        self.in_flight -= 1
+        if not errorIndication:
+            INFORM_STATS.count("notifInformsAcked")
+        elif attempt < INFORM_RETRIES:
+            INFORM_STATS.count("notifInformsRetried")
+            self.waiting += 1
+            delay = min(INFORM_BACKOFF_MAX, INFORM_BACKOFF * 2 ** attempt)
+            asyncio.get_running_loop().call_later(delay, self._retry, varBinds, attempt + 1)
+        else:
+            INFORM_STATS.count("notifInformsDropped")
+            print(f"[ERROR] INFORM a {self.name} sin confirmar tras {attempt + 1} intentos: {errorIndication}")
+        self._pump()
+
+
+    def _retry(self, varBinds, attempt):
+        self.waiting -= 1
+        self.queue.append((varBinds, attempt))
+        self._pump()
+
+
+
+
+class InformStats:
+    """Contadores de INFORM publicados en la MIB (notifInforms*)."""
+
+    def __init__(self):
+        self.values = {"notifInformsAcked": 0, "notifInformsRetried": 0, "notifInformsDropped": 0}
+
+
+    def count(self, name):
+        self.values[name] += 1
+        REGISTRY.update(name, self.values[name])
+
+
+    def refresh_pending(self):
+        pending = sum(t.pending for t in TARGETS.values())
+        if pending != REGISTRY["notifInformsPending"].value:
+            REGISTRY.update("notifInformsPending", pending)
+
+
+
+
+INFORM_STATS = InformStats()
+TARGETS = {}
+TARGET_ADDRESSES = set()   # address_key() de los destinos: de ahí llegan las respuestas a INFORM
+
+
+
+
+def add_notification_target(name, address, type="trap", version=2, community="public",
+                            tags=(DEFAULT_NOTIFY_TAG,)):
+    """Da de alta un destino en el motor y en TARGETS.
+
+    Cada destino tiene sus propios parámetros (versión y comunidad, con un securityName
+    propio y su vista de notificación), su dirección y su entrada de notificación, de
+    modo que se le puede enviar por separado. La dirección decide el transporte: una
+    tupla con host IPv4 o IPv6, o la ruta de un socket Unix.
+    """
+    if type not in ("trap", "inform"):
+        raise ValueError(f"tipo de notificación desconocido para {name}: {type}")
+    if type == "inform" and version == 1:
+        raise ValueError(f"SNMPv1 no admite INFORM ({name})")
+    security_name = f"notify-{name}"
+    params = f"{name}-params"
+    # la respuesta a un INFORM llega desde una dirección etiquetada: pysnmp sólo la acepta
+    # si la comunidad tiene también esa etiqueta
+    config.addV1System(snmp_engine, security_name, community, transportTag=name, securityName=security_name)
+    config.addVacmUser(snmp_engine, 1 if version == 1 else 2, security_name, "noAuthNoPriv",
+                       notifySubTree=(1, 3, 6, 1))
+    config.addTargetParams(snmp_engine, params, security_name, "noAuthNoPriv", 0 if version == 1 else 1)
+    domain = TRANSPORT_KINDS[address_kind(address)][0]
+    config.addTargetAddr(snmp_engine, name, domain, address, params,
+                         timeout=int(INFORM_TIMEOUT * 100), retryCount=0, tagList=" ".join((name,) + tuple(tags)))
+    config.addNotificationTarget(snmp_engine, name, params, name, type)
+    TARGETS[name] = NotificationTarget(name, type, tags, address, version, community)
+    TARGET_ADDRESSES.add(address_key(domain, address))
+    return TARGETS[name]
+
+
+
+
+for _target in NOTIFICATION_TARGETS:
+    add_notification_target(**_target)
+
+
+
+
+def send_notification(name, tag=DEFAULT_NOTIFY_TAG, governed=True):
+    """Envía la notificación a todos los destinos con la etiqueta tag sin salir del bucle.
+
+    sendVarBinds sólo encola un datagrama por destino en el transporte asyncio del
+    motor, así que no bloquea y no hace falta (ni conviene) llamarlo desde otro hilo.
+    Los destinos no se esperan entre sí: un error o un destino caído sólo le afecta a él.
+    Con governed, el envío pasa antes por los límites de ritmo de GOVERNOR (por tipo y
+    por destino). Devuelve a cuántos destinos ha salido.
+    """
+    if governed and not GOVERNOR.allow_type(name):
+        GOVERNOR.suppress(name)
+        return 0
+    varBinds = NOTIFICATIONS[name].varbinds()
+    errors = []
+    sent = 0
+    for target in TARGETS.values():
+        if tag not in target.tags:
+            continue
+        if governed and not GOVERNOR.allow_target(target.name):
+            GOVERNOR.suppress(name)
+            continue
+        try:
+            target.send(varBinds)
+            sent += 1
+        except Exception as e:
+            errors.append(f"{target.name}: {e}")
+    if errors:
+        raise RuntimeError("; ".join(errors))
+    return sent
+
+
+
+
+NOTIFY_SOURCES = {"udp": ("0.0.0.0", 0), "udp6": ("::", 0)}   # origen si no hay listener de ese tipo
+
+
+
+
+def open_notification_transports():
+    """Abre un transporte de origen para cada tipo de dirección de los destinos que no tenga
+    aquí su listener (con workers, los UDP son de ellos). UDP/IPv4 siempre, para los que se
+    den de alta después."""
+    for kind in sorted({address_kind(t.address) for t in TARGETS.values()} | {"udp"}):
+        if TRANSPORT_KINDS[kind][0] in OPEN_TRANSPORTS:
+            continue
+        if kind == "unix":
+            print("[WARN] Hay destinos de notificación Unix pero ningún listener Unix abierto: no les llegarán")
+            continue
+        open_transport(NOTIFY_SOURCES[kind], kind=kind)
+
+
+
+
+# --------------------------------------------------------------------
+# GOBERNADOR DE NOTIFICACIONES (histéresis, rearme y límites de ritmo)
+# --------------------------------------------------------------------
+NOTIFY_REARM_INTERVAL = 60.0      # segundos mínimos entre dos disparos de la misma alarma
+NOTIFY_TYPE_RATE = (1 / 60, 3)    # (fichas por segundo, ráfaga) por tipo de notificación
+NOTIFY_TARGET_RATE = (1.0, 10)    # (fichas por segundo, ráfaga) por destino
+NOTIFY_SUMMARY_INTERVAL = 60.0    # cada cuánto se resume lo suprimido (si hubo algo)
+
+
+
+
+class TokenBucket:
+    """Cubo de fichas: se rellena a rate fichas por segundo hasta burst y cada envío gasta una."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+
+    def take(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+
+
+class Alarm:
+    """Alarma con histéresis sobre una métrica.
+
+    Salta al superar el umbral de disparo y queda activa hasta bajar del de rearme
+    (como mucho igual al de disparo), así que un valor que oscila alrededor del umbral
+    no genera una notificación por cruce. Entre dos disparos tiene que pasar además
+    NOTIFY_REARM_INTERVAL: uno antes de tiempo se da por suprimido, pero la alarma
+    queda activa igualmente.
+    """
+
+    __slots__ = ("source", "active", "raised_at", "alarm_id")
+
+
+    def __init__(self, source=""):
+        self.source = source
+        self.active = False
+        self.raised_at = None
+        self.alarm_id = 0     # fila de alarmTable de la última activación
+
+
+    def update(self, value, raise_thr, clear_thr, now=None):
+        """Devuelve "raise", "suppressed", "clear" o None si no cambia nada."""
+        if self.active:
+            if value < min(clear_thr, raise_thr):
+                self.active = False
+                return "clear"
+            return None
+        if value <= raise_thr:
+            return None
+        self.active = True
+        now = time.monotonic() if now is None else now
+        if self.raised_at is not None and now - self.raised_at < NOTIFY_REARM_INTERVAL:
+            return "suppressed"
+        self.raised_at = now
+        return "raise"
+
+
+
+
+class NotificationGovernor:
+    """Límites de ritmo por tipo de notificación y por destino, y recuento de lo suprimido.
+
+    Todo lo que no sale (por el rearme de una alarma o por falta de fichas) se suma en
+    notifSuppressed. Cada NOTIFY_SUMMARY_INTERVAL, si hubo algo, se envía un único
+    notifSuppressedNotification con lo suprimido en el intervalo y su desglose por tipo;
+    ese resumen no pasa por los límites.
+    """
+
+    def __init__(self):
+        self.type_buckets = {}
+        self.target_buckets = {}
+        self.pending = {}   # tipo -> suprimidas desde el último resumen
+        self.total = 0
+
+
+    def allow_type(self, name):
+        bucket = self.type_buckets.get(name)
+        if bucket is None:
+            bucket = self.type_buckets[name] = TokenBucket(*NOTIFY_TYPE_RATE)
+        return bucket.take()
+
+
+    def allow_target(self, name):
+        bucket = self.target_buckets.get(name)
+        if bucket is None:
+            bucket = self.target_buckets[name] = TokenBucket(*NOTIFY_TARGET_RATE)
+        return bucket.take()
+
+
+    def suppress(self, name, count=1):
+        self.pending[name] = self.pending.get(name, 0) + count
+        self.total += count
+        REGISTRY.update("notifSuppressed", self.total)
+
+
+    def summarize(self):
+        if not self.pending:
+            return
+        last = sum(self.pending.values())
+        detail = ",".join(f"{name}={n}" for name, n in sorted(self.pending.items(), key=lambda kv: -kv[1]))
+        self.pending = {}
+        REGISTRY.update("notifSuppressedLast", last)
+        REGISTRY.update("notifSuppressedDetail", detail[:255])
+        try:
+            send_notification("notifSuppressedNotification", governed=False)
+            print(f"[TRAP] {last} notificaciones suprimidas en {NOTIFY_SUMMARY_INTERVAL:g} s ({detail}) - Resumen enviado")
+        except Exception as e:
+            print(f"[ERROR] Fallo al enviar el resumen de suprimidas: {e}")
+
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(NOTIFY_SUMMARY_INTERVAL)
+            self.summarize()
+
+
+
+
+GOVERNOR = NotificationGovernor()
+
+
+
+
+
+# --------------------------------------------------------------------
+# TABLA DE ALARMAS (alarmTable, búfer circular)
+# --------------------------------------------------------------------
+ALARM_TABLE_SIZE = 100   # filas de alarmTable: con la tabla llena, la más antigua deja su sitio
+ALARM_ACTIVE, ALARM_CLEARED = 1, 2
+
+
+
+
+class AlarmLog:
+    """alarmTable como búfer circular de ALARM_TABLE_SIZE filas.
+
+    Los alarmId crecen de uno en uno, así que las filas presentes son siempre el rango
+    [oldest, next_id). Con la tabla llena, una alarma nueva ocupa la posición de la más
+    antigua (MibTable.recycle_row): insertar no reserva memoria y la tabla no crece.
+    """
+
+    def __init__(self, table, size=ALARM_TABLE_SIZE):
+        self.table = table
+        self.size = size
+        self.next_id = 1
+        self.oldest = 1
+
+
+    def open(self, source, value):
+        alarm_id = self.next_id
+        self.next_id += 1
+        values = {"alarmSource": source, "alarmState": ALARM_ACTIVE, "alarmPeak": value,
+                  "alarmRaiseTime": time.strftime("%Y-%m-%d,%H:%M:%S"), "alarmClearTime": ""}
+        if len(self.table) >= self.size:
+            self.table.recycle_row((self.oldest,), (alarm_id,), **values)
+            self.oldest += 1
+        else:
+            self.table.add_row((alarm_id,), **values)
+        return alarm_id
+
+
+    def track(self, alarm, state, value, sign=1):
+        """Refleja en la tabla el resultado de alarm.update (se haya notificado o no).
+
+        sign es el sentido de la alarma (-1 para las de "por debajo de"): el pico es
+        el valor más alejado del umbral en ese sentido.
+        """
+        if state in ("raise", "suppressed"):
+            alarm.alarm_id = self.open(alarm.source, value)
+            return
+        index = (alarm.alarm_id,)
+        if not self.table.has_row(index):
+            return   # ya la ha pisado una más reciente
+        if state == "clear":
+            self.table.set_cell("alarmState", index, ALARM_CLEARED)
+            self.table.set_cell("alarmClearTime", index, time.strftime("%Y-%m-%d,%H:%M:%S"))
+        elif alarm.active and sign * value > sign * self.table.get_cell("alarmPeak", index):
+            self.table.set_cell("alarmPeak", index, value)
+
+
+
+
+ALARMS = AlarmLog(REGISTRY.tables_by_name["alarmTable"])
+
+
+
+
+
+# --------------------------------------------------------------------
+# MOTOR DE REGLAS (ruleTable)
+# --------------------------------------------------------------------
+RULE_COLUMNS = ("ruleObject", "ruleOperator", "ruleThreshold", "ruleHysteresis",
+                "ruleAggregate", "ruleWindow", "ruleNotification")
+# ruleOperator -> (signo, ajuste): todo se reduce a "signo * valor > signo * umbral + ajuste"
+RULE_OPERATORS = {1: (1, 0), 2: (1, -1), 3: (-1, 0), 4: (-1, -1)}
+RULE_SYMBOLS = {1: ">", 2: ">=", 3: "<", 4: "<="}
+RULE_AGGREGATES = {2: SlidingWindow.avg, 3: SlidingWindow.min, 4: SlidingWindow.max,
+                   5: lambda window: window.percentile(95)}
+RULE_IDLE, RULE_TRIGGERED = 1, 2
+
+
+
+
+class Rule:
+    """Regla de ruleTable ya compilada: lo necesario para evaluarla sin volver a la tabla.
+
+    Las comparaciones "menor que" se evalúan sobre el valor cambiado de signo, así que
+    todas se resuelven con una Alarm (histéresis y rearme incluidos).
+    """
+
+    __slots__ = ("index", "key", "object", "op", "threshold", "sign", "raise_thr", "clear_thr",
+                 "aggregate", "size", "window", "notification", "alarm", "notified", "value")
+
+
+    def __init__(self, index, key):
+        name, op, threshold, hysteresis, aggregate, window, notification = key
+        self.index = index
+        self.key = key
+        self.object = name
+        self.op = op
+        self.threshold = threshold
+        self.sign, adjust = RULE_OPERATORS.get(op, (1, 0))
+        self.raise_thr = self.sign * threshold + adjust
+        self.clear_thr = self.raise_thr - hysteresis
+        self.aggregate = RULE_AGGREGATES.get(aggregate) if window else None
+        self.size = max(1, round(window / EVAL_INTERVAL)) if self.aggregate else 0
+        self.window = None
+        self.notification = notification
+        self.alarm = Alarm(f"rule {index}")
+        self.notified = False
+        self.value = 0          # último valor comparado
+
+
+
+
+class RuleEngine:
+    """Reglas activas de ruleTable, compiladas en un índice por objeto vigilado.
+
+    compile() se ejecuta al arrancar y después de cada SET sobre la tabla. feed(objeto,
+    valor) sólo toca las ventanas y las reglas de ese objeto, así que el coste de una
+    muestra depende de cuántas reglas la miran, no del total de reglas. Las reglas que
+    miran el mismo objeto con la misma ventana comparten una SlidingWindow.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.rules = {}       # índice -> Rule (conserva el estado si la regla no cambia)
+        self.by_object = {}   # objeto -> [Rule]
+        self.windows = {}     # (objeto, muestras) -> SlidingWindow
+        self.sources = {}     # objeto -> [SlidingWindow] que se alimentan con sus muestras
+        table.validator = self.validate
+        table.on_change = lambda table: self.compile()
+
+
+    def validate(self, column, value):
+        if column == "ruleObject":
+            obj = REGISTRY.by_name.get(value)
+            if obj is None or not issubclass(obj._asn1, univ.Integer):
+                return 10   # wrongValue: tiene que ser un escalar entero de la MIB
+            if obj.syntax == "Counter64":
+                return 10   # sólo crece y no cabe en ruleValue: para eso están los *Rate
+        elif column == "ruleNotification" and value and value not in NOTIFICATIONS:
+            return 10
+        return 0
+
+
+    def compile(self):
+        table = self.table
+        rules = {}
+        by_object = {}
+        windows = {}
+        for index in table.rows:
+            if table.get_cell("ruleStatus", index) != ACTIVE:
+                continue
+            key = tuple(table.get_cell(c, index) for c in RULE_COLUMNS)
+            if key[0] not in REGISTRY.by_name:
+                print(f"[WARN] Regla {index[0]}: {key[0]} no existe en la MIB, se ignora")
+                continue
+            rule = self.rules.get(index)
+            if rule is None or rule.key != key:
+                rule = Rule(index[0], key)
+                table.set_cell("ruleState", index, RULE_IDLE)
+            rules[index] = rule
+            by_object.setdefault(rule.object, []).append(rule)
+            if rule.size:
+                wkey = (rule.object, rule.size)
+                if wkey not in windows:
+                    windows[wkey] = self.windows.get(wkey) or SlidingWindow(rule.size)
+                rule.window = windows[wkey]
+        # una regla borrada, desactivada o cambiada no deja su alarma abierta (ni al NMS esperando)
+        for index, rule in self.rules.items():
+            if rules.get(index) is not rule and rule.alarm.active:
+                ALARMS.track(rule.alarm, "clear", rule.value, rule.sign)
+                if rule.notified:
+                    self.fire(rule, "ruleClearedNotification", rule.value)
+        self.rules, self.by_object, self.windows = rules, by_object, windows
+        self.sources = {}
+        for (name, _), window in windows.items():
+            self.sources.setdefault(name, []).append(window)
+
+
+    def feed(self, name, value, now=None):
+        """Evalúa una muestra del objeto name contra las reglas que lo miran."""
+        rules = self.by_object.get(name)
+        if not rules:
+            return
+        for window in self.sources.get(name, ()):
+            window.add(value)
+        for rule in rules:
+            self.check(rule, value if rule.window is None else rule.aggregate(rule.window), now)
+
+
+    def evaluate(self, now=None):
+        """Una muestra de cada objeto vigilado (en cada ciclo de evaluación)."""
+        now = time.monotonic() if now is None else now
+        for name in self.by_object:
+            self.feed(name, int(REGISTRY[name].value), now)
+
+
+    def check(self, rule, value, now=None):
+        index = (rule.index,)
+        rule.value = value
+        self.table.set_cell("ruleValue", index, value)
+        state = rule.alarm.update(rule.sign * value, rule.raise_thr, rule.clear_thr, now)
+        if state is None and not rule.alarm.active:
+            return
+        ALARMS.track(rule.alarm, state, value, rule.sign)
+        if state == "raise":
+            self.table.set_cell("ruleState", index, RULE_TRIGGERED)
+            rule.notified = self.fire(rule, rule.notification, value) if rule.notification else False
+        elif state == "suppressed":
+            self.table.set_cell("ruleState", index, RULE_TRIGGERED)
+            rule.notified = False
+            if rule.notification:
+                GOVERNOR.suppress(rule.notification)
+        elif state == "clear":
+            self.table.set_cell("ruleState", index, RULE_IDLE)
+            if rule.notified:
+                self.fire(rule, "ruleClearedNotification", value)
+            rule.notified = False
+
+
+    def fire(self, rule, notification, value):
+        REGISTRY.update("ruleFiredIndex", rule.index)
+        REGISTRY.update("ruleFiredObject", rule.object)
+        REGISTRY.update("ruleFiredValue", value)
+        what = f"Regla {rule.index}: {rule.object}={value} {RULE_SYMBOLS.get(rule.op, '>')} {rule.threshold}"
+        if notification == "ruleClearedNotification":
+            what = f"Regla {rule.index} rearmada: {rule.object}={value}"
+        try:
+            sent = send_notification(notification)
+            print(f"[TRAP] {what} - " + (f"{notification} enviado a {sent} destinos" if sent
+                                         else "suprimido por límite de ritmo"))
+            return sent > 0
+        except Exception as e:
+            print(f"[ERROR] Fallo al enviar TRAP: {e}")
+            return False
+
+
+
+
+RULES = RuleEngine(REGISTRY.tables_by_name["ruleTable"])
+RULES.compile()
+
+
+
+
+# --------------------------------------------------------------------
+# MONITOR DE CPU + TRAP + EMAIL
+# --------------------------------------------------------------------
+def format_core_list(cores, limit=255):
+    """[1, 2, 3, 4, 17] -> '1-4,17' (recortado a limit caracteres)."""
+    parts = []
+    start = prev = None
+    for c in cores:
+        if prev is not None and c == prev + 1:
+            prev = c
+            continue
+        if start is not None:
+            parts.append(f"{start}-{prev}" if prev != start else str(start))
+        start = prev = c
+    if start is not None:
+        parts.append(f"{start}-{prev}" if prev != start else str(start))
+    text = ",".join(parts)
+    return text if len(text) <= limit else text[:limit - 3].rsplit(",", 1)[0] + ",.."
+
+
+
+
+async def cpu_monitor():
+    cpu_alarm = Alarm("cpu")
+    cpu_notified = False   # sólo se notifica la recuperación de una alarma notificada
+    core_alarms = {}
+
+
+    while True:
+        await asyncio.sleep(EVAL_INTERVAL)
+        cpu = CPU_SAMPLER.current()
+        record_history()
+        CPU_AGGREGATES.add(cpu)
+        thr = int(REGISTRY["cpuThreshold"].value)
+        email = REGISTRY["managerEmail"].value
+        tick = time.monotonic()
+
+
+        # por núcleo: una muestra, un recorrido y como mucho un trap agregado por ciclo
+        core_thr = int(REGISTRY["cpuCoreThreshold"].value)
+        core_clear = int(REGISTRY["cpuCoreClearThreshold"].value)
+        hot = []
+        new_hot = []
+        core_suppressed = False
+        for i, u in enumerate(CORE_SAMPLER.current(), 1):
+            if u > core_thr:
+                hot.append(i)
+            alarm = core_alarms.get(i)
+            if alarm is None:
+                alarm = core_alarms[i] = Alarm(f"core {i}")
+            state = alarm.update(u, core_thr, core_clear, tick)
+            ALARMS.track(alarm, state, u)
+            if state == "raise":
+                new_hot.append(i)
+            elif state == "suppressed":
+                core_suppressed = True
+        REGISTRY.update("cpuHotCoreCount", len(hot))
+        REGISTRY.update("cpuHotCores", format_core_list(hot))
+        if new_hot:
+            try:
+                sent = send_notification("cpuCoreOverThresholdNotification")
+                print(f"[TRAP] Núcleos > {core_thr}%: {format_core_list(new_hot)} - "
+                      + (f"Trap enviado a {sent} destinos" if sent else "suprimido por límite de ritmo"))
+            except Exception as e:
+                print(f"[ERROR] Fallo al enviar TRAP: {e}")
+        elif core_suppressed:
+            GOVERNOR.suppress("cpuCoreOverThresholdNotification")
+
+
+        clear = int(REGISTRY["cpuClearThreshold"].value)
+        # la alarma de CPU se decide con cpuTriggerSource: la muestra o un agregado de ventana
+        value, source = trigger_value(cpu)
+        label = "CPU" if source == "cpuUsage" else source
+        state = cpu_alarm.update(value, thr, clear, tick)
+        ALARMS.track(cpu_alarm, state, value)
+        if state in ("raise", "suppressed"):
+            REGISTRY.update("cpuAlarmId", cpu_alarm.alarm_id)
+        if state == "clear":
+            if cpu_notified:
+                try:
+                    sent = send_notification("cpuThresholdCleared")
+                    print(f"[TRAP] {label}={value}% < {min(clear, thr)}% - Alarma {cpu_alarm.alarm_id} cerrada, "
+                          + (f"Trap enviado a {sent} destinos" if sent else "suprimido por límite de ritmo"))
+                except Exception as e:
+                    print(f"[ERROR] Fallo al enviar TRAP: {e}")
+            cpu_notified = False
+        elif state == "suppressed":
+            GOVERNOR.suppress("cpuOverThresholdNotification")
+            print(f"[SUPRIMIDO] {label}={value}% > {thr}% antes de {NOTIFY_REARM_INTERVAL:g} s desde la última alarma")
+        elif state == "raise":
+            now = time.strftime("%Y-%m-%d,%H:%M:%S")
+            REGISTRY.update("eventTime", now)
+
+
+            cpu_notified = True
+            try:
+                sent = send_notification("cpuOverThresholdNotification")
+                cpu_notified = sent > 0
+                print(f"[TRAP] {label}={value}% > {thr}% - "
+                      + (f"Trap enviado a {sent} destinos" if sent else "suprimido por límite de ritmo")
+                      + f", eventTime={now}")
+            except Exception as e:
+                print(f"[ERROR] Fallo al enviar TRAP: {e}")
+
+
+            if ENABLE_EMAIL:
+                EMAIL.submit(email, f"Alerta SNMP: {label} {value}% > {thr}%", f"{value}%|{thr}%|{now}")
+
+
+        RULES.evaluate(tick)
+
+
+
+
+# --------------------------------------------------------------------
+# ALMACÉN COMPARTIDO DE ESCALARES (memoria compartida, un seqlock por OID)
+# --------------------------------------------------------------------
+STORE_NAME = None                  # p. ej. "mini_agent_store" para que lo abran otros procesos; None = sólo con workers
+STORE_STRING_SIZE = 255            # bytes máximos de una cadena en el almacén (se recortan)
+
+
+# cabecera: marca, versión, tamaño de registro, nº de registros, bytes del directorio,
+# PID del propietario, generación (impar = publicando)
+_STORE_HEADER = struct.Struct("!4sHHIIIQ")
+_STORE_MAGIC = b"MSA1"
+_STORE_VERSION = 2
+# registro: secuencia (impar = escribiendo), valor entero, longitud y bytes de la cadena
+_STORE_RECORD = struct.Struct(f"!QqH{STORE_STRING_SIZE}s")
+_STORE_RECORD_SIZE = (_STORE_RECORD.size + 7) // 8 * 8
+_STORE_SEQ = struct.Struct("!Q")
+_STORE_VALUE = struct.Struct("!qH")
+_OWN_SEGMENTS = set()   # segmentos creados por este proceso (su resource_tracker los borra)
+
+
+
+
+class SharedStore:
+    """Escalares del registro en un segmento de memoria compartida con formato fijo.
+
+    Tras la cabecera va un directorio JSON (OID, nombre, sintaxis; se escribe una vez)
+    y después un registro de tamaño fijo por escalar, cada uno con su seqlock: quien
+    escribe pone la secuencia impar, escribe el valor y la deja par; quien lee repite
+    si la secuencia era impar o ha cambiado mientras leía. Leer un valor no toma
+    ningún cerrojo ni deserializa nada, y el escritor no espera a nadie. La generación
+    de la cabecera es a su vez un seqlock de todo el almacén: es impar mientras dura un
+    publish() que cambia algo, así que un lector sin cambios que cargar sólo mira ocho
+    bytes y snapshot() valida una única copia de todos los registros.
+    """
+
+    def __init__(self, shm, directory, owner):
+        self.shm = shm
+        self.directory = directory   # [(oid, nombre, sintaxis)] en el orden de los registros
+        self.slots = {name: i for i, (_, name, _) in enumerate(directory)}
+        self.ints = [issubclass(SYNTAXES[syntax][0], univ.Integer) for _, _, syntax in directory]
+        self.names = [name for _, name, _ in directory]
+        # todos los registros de una vez: el entero de los numéricos, longitud y bytes de las cadenas
+        pad = _STORE_RECORD_SIZE - _STORE_RECORD.size
+        self.records = struct.Struct("!" + "".join(
+            f"8xq{2 + STORE_STRING_SIZE + pad}x" if is_int else f"16xH{STORE_STRING_SIZE}s{pad}x"
+            for is_int in self.ints))
+        self.owner = owner
+        _, _, _, _, dir_len, _, _ = _STORE_HEADER.unpack_from(shm.buf, 0)
+        self.base = _STORE_HEADER.size + (dir_len + 7) // 8 * 8
+        self.values = [None] * len(directory)   # propietario: lo último escrito
+        self.seqs = [0] * len(directory)        # secuencia de cada registro (escrita o cargada)
+        self.generation = 0
+        self.writes = 0
+
+
+    @classmethod
+    def create(cls, registry, name=None):
+        directory = [(obj.oid, obj.name, obj.syntax)
+                     for _, obj in sorted(registry.objects.items())]
+        raw = json.dumps(directory).encode("utf-8")
+        size = _STORE_HEADER.size + (len(raw) + 7) // 8 * 8 + _STORE_RECORD_SIZE * len(directory)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            cls._remove_stale(name)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _OWN_SEGMENTS.add(shm._name)
+        _STORE_HEADER.pack_into(shm.buf, 0, _STORE_MAGIC, _STORE_VERSION, _STORE_RECORD_SIZE,
+                                len(directory), len(raw), os.getpid(), 0)
+        shm.buf[_STORE_HEADER.size:_STORE_HEADER.size + len(raw)] = raw
+        store = cls(shm, directory, owner=True)
+        store.publish(registry)
+        return store
+
+
+    @staticmethod
+    def _remove_stale(name):
+        """Borra el segmento name sólo si es de un agente que ya no existe.
+
+        Si su propietario sigue vivo, o el segmento no es un almacén de este agente, no
+        se toca: se lanza RuntimeError en vez de quitarle el almacén a otro proceso.
+        """
+        old = shared_memory.SharedMemory(name=name)
+        problem = None
+        if old.size < _STORE_HEADER.size:
+            problem = f"El segmento {name} existe y no es un almacén de este agente"
+        else:
+            magic, version, _, _, _, pid, _ = _STORE_HEADER.unpack_from(old.buf, 0)
+            if magic != _STORE_MAGIC or version != _STORE_VERSION:
+                problem = f"El segmento {name} existe y no es un almacén de este agente"
+            elif _process_alive(pid):
+                problem = f"El almacén {name} es del agente en marcha con PID {pid}: use otro STORE_NAME o None"
+        old.close()
+        if problem:
+            if old._name not in _OWN_SEGMENTS:
+                _untrack(old)
+            raise RuntimeError(problem)
+        print(f"[WARN] El almacén {name} lo dejó el agente {pid}, que ya no existe: se reemplaza")
+        old.unlink()   # también lo quita del resource_tracker
+
+
+    @classmethod
+    def attach(cls, name):
+        """Abre el almacén de un agente en marcha (lectores de otros procesos)."""
+        shm = shared_memory.SharedMemory(name=name)
+        if shm._name not in _OWN_SEGMENTS:
+            _untrack(shm)
+        magic, version, record_size, count, dir_len, _, _ = _STORE_HEADER.unpack_from(shm.buf, 0)
+        if magic != _STORE_MAGIC or version != _STORE_VERSION or record_size != _STORE_RECORD_SIZE:
+            shm.close()
+            raise ValueError(f"{name} no es un almacén de este agente")
+        raw = bytes(shm.buf[_STORE_HEADER.size:_STORE_HEADER.size + dir_len])
+        return cls(shm, [tuple(d) for d in json.loads(raw)], owner=False)
+
+
+    @property
+    def owner_pid(self):
+        return _STORE_HEADER.unpack_from(self.shm.buf, 0)[5]
+
+
+    @property
+    def name(self):
+        return self.shm.name
+
+
+    def current_generation(self):
+        return _STORE_SEQ.unpack_from(self.shm.buf, _STORE_HEADER.size - _STORE_SEQ.size)[0]
+
+
+    def _set_generation(self, generation):
+        self.generation = generation
+        _STORE_SEQ.pack_into(self.shm.buf, _STORE_HEADER.size - _STORE_SEQ.size, generation)
+
+
+    def _write(self, i, value):
+        buf = self.shm.buf
+        offset = self.base + i * _STORE_RECORD_SIZE
+        seq = self.seqs[i] + 1
+        _STORE_SEQ.pack_into(buf, offset, seq)
+        if self.ints[i]:
+            _STORE_VALUE.pack_into(buf, offset + 8, max(min(int(value), 2 ** 63 - 1), -2 ** 63), 0)
+        else:
+            data = str(value).encode("utf-8")[:STORE_STRING_SIZE]
+            _STORE_VALUE.pack_into(buf, offset + 8, 0, len(data))
+            start = offset + _STORE_SEQ.size + _STORE_VALUE.size
+            buf[start:start + len(data)] = data
+        self.seqs[i] = seq + 1
+        _STORE_SEQ.pack_into(buf, offset, seq + 1)
+
+
+    def publish(self, registry=None):
+        """Escribe los escalares que han cambiado desde la última vez (propietario)."""
+        by_name = (registry or REGISTRY).by_name
+        values = self.values
+        changed = [(i, value) for i, value in enumerate(by_name[name].value for name in self.names)
+                   if value != values[i]]
+        if not changed:
+            return 0
+        self._set_generation(self.generation + 1)
+        for i, value in changed:
+            self._write(i, value)
+            values[i] = value
+        self._set_generation(self.generation + 1)
+        self.writes += len(changed)
+        return len(changed)
+
+
+    def read_slot(self, i, retries=1000):
+        """(secuencia, valor) consistentes del registro i, o (None, None) si no se ha podido."""
+        buf = self.shm.buf
+        offset = self.base + i * _STORE_RECORD_SIZE
+        start = offset + _STORE_SEQ.size + _STORE_VALUE.size
+        for _ in range(retries):
+            seq = _STORE_SEQ.unpack_from(buf, offset)[0]
+            if seq & 1:
+                continue
+            number, length = _STORE_VALUE.unpack_from(buf, offset + 8)
+            value = number if self.ints[i] else bytes(buf[start:start + length]).decode("utf-8", "replace")
+            if _STORE_SEQ.unpack_from(buf, offset)[0] == seq:
+                return seq, value
+        return None, None
+
+
+    def read(self, name):
+        return self.read_slot(self.slots[name])[1]
+
+
+    def snapshot(self, retries=3):
+        """{nombre: valor} de todos los escalares, leídos de la misma publicación.
+
+        Con la generación par antes y después de una sola copia de los registros, ningún
+        publish() ha escrito entre medias; la copia se desempaqueta con un único struct.
+        Si el propietario no deja de publicar, se lee registro a registro.
+        """
+        buf = self.shm.buf
+        region = buf[self.base:self.base + len(self.directory) * _STORE_RECORD_SIZE]
+        for _ in range(retries):
+            generation = self.current_generation()
+            if generation & 1:
+                continue
+            fields = self.records.unpack(region)
+            if self.current_generation() == generation:
+                break
+        else:
+            return {name: self.read_slot(i)[1] for i, name in enumerate(self.names)}
+        # los campos salen en orden: un entero por numérico, (longitud, bytes) por cadena
+        result, k = {}, 0
+        for name, is_int in zip(self.names, self.ints):
+            if is_int:
+                result[name] = fields[k]
+                k += 1
+            else:
+                result[name] = fields[k + 1][:fields[k]].decode("utf-8", "replace")
+                k += 2
+        return result
+
+
+    def refresh(self, registry=None):
+        """Worker: carga en el registro local los escalares cuya secuencia ha cambiado."""
+        generation = self.current_generation()
+        if generation == self.generation:
+            return 0
+        by_name = (registry or REGISTRY).by_name
+        loaded = 0
+        for i, (_, name, _) in enumerate(self.directory):
+            seq = _STORE_SEQ.unpack_from(self.shm.buf, self.base + i * _STORE_RECORD_SIZE)[0]
+            if seq == self.seqs[i]:
+                continue
+            seq, value = self.read_slot(i)
+            if seq is None:
+                continue   # a medio escribir: en la siguiente vuelta
+            obj = by_name[name]
+            obj.value = value
+            obj._vb = None
+            obj._size = None
+            self.seqs[i] = seq
+            loaded += 1
+        self.generation = generation
+        return loaded
+
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+
+
+def _untrack(shm):
+    try:
+        # en 3.11 el resource_tracker de quien sólo abre el segmento lo borraría al salir
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True    # existe, aunque sea de otro usuario
+    return True
+
+
+
+
+STORE = None   # SharedStore del agente (se crea en main(); los workers lo heredan)
+
+
+
+
+# --------------------------------------------------------------------
+# MODO MULTIPROCESO (workers con SO_REUSEPORT)
+# --------------------------------------------------------------------
+WORKERS = 0                        # procesos que atienden GET/GETNEXT/GETBULK; 0 = un solo proceso
+SNAPSHOT_SIZE = 4 * 1024 * 1024    # bytes del segmento compartido con la copia de las tablas
+SNAPSHOT_INTERVAL = 1.0            # cada cuánto se publica el registro (STORE y tablas)
+SNAPSHOT_POLL = 0.1                # cada cuánto mira un worker si hay algo nuevo
+REUSE_PORT_KINDS = ("udp", "udp6")  # listeners que abren los workers; los Unix se quedan en el propietario
+
+
+_SNAP_HEADER = struct.Struct("!QI")   # secuencia (impar = escribiendo), longitud
+_FWD_HEADER = struct.Struct("!I")     # identificador de un SET reenviado
+
+
+
+
+class RegistrySnapshot:
+    """Copia de las tablas del registro en memoria compartida, protegida con un seqlock.
+
+    El proceso propietario escribe (publish) y los workers leen (refresh). Mientras
+    escribe, la secuencia es impar; un lector copia los datos sólo si la secuencia es
+    par y sigue siendo la misma después de copiarlos, así que nunca ve una copia a
+    medias y ninguno de los dos espera al otro. Los workers heredan el segmento con
+    fork, no lo abren por nombre. Los escalares no van aquí sino en STORE, registro a
+    registro; las tablas cambian de forma y se copian enteras.
+    """
+
+    def __init__(self, size=SNAPSHOT_SIZE):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.seq = 0            # propietario: última publicada; worker: última cargada
+        self.published = None   # propietario: REGISTRY.tables_version() de la última publicada
+        self.publishes = 0
+        self.loads = 0
+
+
+    def publish(self):
+        version = REGISTRY.tables_version()
+        if version == self.published:
+            return   # ninguna tabla ha cambiado: los workers ya tienen esta copia
+        data = pickle.dumps(REGISTRY.dump_tables(), protocol=pickle.HIGHEST_PROTOCOL)
+        buf = self.shm.buf
+        if _SNAP_HEADER.size + len(data) > len(buf):
+            print(f"[ERROR] Las tablas ({len(data)} bytes) no caben en SNAPSHOT_SIZE")
+            return
+        _SNAP_HEADER.pack_into(buf, 0, self.seq + 1, len(data))
+        buf[_SNAP_HEADER.size:_SNAP_HEADER.size + len(data)] = data
+        self.seq += 2
+        _SNAP_HEADER.pack_into(buf, 0, self.seq, len(data))
+        self.published = version
+        self.publishes += 1
+
+
+    def refresh(self):
+        """Carga la última copia publicada si es nueva; devuelve si ha cargado algo."""
+        buf = self.shm.buf
+        seq, length = _SNAP_HEADER.unpack_from(buf, 0)
+        if seq == self.seq or seq & 1:
+            return False   # nada nuevo, o el propietario está escribiendo: en el siguiente intento
+        data = bytes(buf[_SNAP_HEADER.size:_SNAP_HEADER.size + length])
+        if _SNAP_HEADER.unpack_from(buf, 0)[0] != seq:
+            return False
+        REGISTRY.restore_tables(pickle.loads(data))
+        self.seq = seq
+        self.loads += 1
+        return True
+
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+
+
+class SetForwarder:
+    """Lado worker: manda cada SET al proceso propietario por su Pipe y responde al volver."""
+
+    def __init__(self, conn, loop):
+        self.conn = conn
+        self.loop = loop
+        self.pending = {}   # identificador -> (PDU, función que envía la respuesta al gestor)
+        self.next_id = 0
+        loop.add_reader(conn.fileno(), self._on_reply)
+
+
+    @staticmethod
+    def _gen_err(pdu, reply):
+        reply(set_error_response(v2c.apiPDU.getResponse(pdu), v2c.apiPDU.getVarBinds(pdu), 5, 1))
+
+
+    def forward(self, pdu, reply):
+        if self.conn is None:
+            self._gen_err(pdu, reply)
+            return
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.pending[self.next_id] = (pdu, reply)
+        self.conn.send_bytes(_FWD_HEADER.pack(self.next_id) + encoder.encode(pdu))
+
+
+    def _on_reply(self):
+        try:
+            data = self.conn.recv_bytes()
+        except (EOFError, OSError):
+            # sin propietario no hay quien escriba: genErr a lo pendiente y a lo que venga
+            self.loop.remove_reader(self.conn.fileno())
+            self.conn = None
+            print("[ERROR] Worker sin proceso propietario: los SET responderán genErr")
+            for pdu, reply in self.pending.values():
+                self._gen_err(pdu, reply)
+            self.pending.clear()
+            return
+        pdu, reply = self.pending.pop(_FWD_HEADER.unpack_from(data)[0], (None, None))
+        if reply is None:
+            return
+        rsp_pdu, _ = decoder.decode(data[_FWD_HEADER.size:], asn1Spec=v2c.ResponsePDU())
+        refresh_registry()   # el propietario publica antes de responder: el siguiente GET ya lo ve
+        reply(rsp_pdu)
+
+
+
+
+def serve_forwarded_sets(loop, conn):
+    """Lado propietario: aplica los SET que llegan de un worker y le devuelve la respuesta."""
+
+    def on_request():
+        try:
+            data = conn.recv_bytes()
+        except (EOFError, OSError):
+            loop.remove_reader(conn.fileno())
+            return
+        pdu, _ = decoder.decode(data[_FWD_HEADER.size:], asn1Spec=v2c.SetRequestPDU())
+        rsp_pdu = apply_set(pdu)
+        publish_registry()
+        conn.send_bytes(data[:_FWD_HEADER.size] + encoder.encode(rsp_pdu))
+
+
+    loop.add_reader(conn.fileno(), on_request)
+
+
+
+
+def worker_main(conn):
+    """Proceso worker (fork del propietario antes de arrancar el bucle)."""
+    global SET_FORWARDER
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # sólo sirve lecturas: sin muestreo propio, el registro llega por STORE y SNAPSHOT
+    for obj in REGISTRY.objects.values():
+        obj.sampler = None
+    for table in REGISTRY.tables:
+        table.sampler = None
+    STORE.owner = False
+    refresh_registry()
+    SET_FORWARDER = SetForwarder(conn, loop)
+    open_listeners(REUSE_PORT_KINDS, reuse_port=True)
+    loop.create_task(run_reader())
+    try:
+        snmp_engine.transportDispatcher.jobStarted(1)
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+
+def start_workers(count):
+    """Publica el registro y arranca count workers; el propietario se queda con los SET."""
+    global SNAPSHOT
+    SNAPSHOT = RegistrySnapshot()
+    SNAPSHOT.publish()
+    ctx = multiprocessing.get_context("fork")
+    workers = []
+    for number in range(1, count + 1):
+        owner_conn, worker_conn = ctx.Pipe()
+        process = ctx.Process(target=worker_main, args=(worker_conn,),
+                              name=f"snmp-worker-{number}", daemon=True)
+        process.start()
+        worker_conn.close()
+        workers.append((process, owner_conn))
+    return workers
+
+
+
+
+def stop_workers(workers):
+    for process, conn in workers:
+        process.terminate()
+    for process, conn in workers:
+        process.join(2)
+        conn.close()
+    SNAPSHOT.close()
+
+
+
+
+SNAPSHOT = None   # RegistrySnapshot compartido con los workers (sólo si WORKERS > 0)
+
+
+
+
+def publish_registry():
+    """Propietario: escalares cambiados a STORE y, si hay workers, las tablas a SNAPSHOT."""
+    STORE.publish()
+    if SNAPSHOT is not None:
+        SNAPSHOT.publish()
+
+
+
+
+def refresh_registry():
+    """Worker: trae lo que haya publicado el propietario."""
+    STORE.refresh()
+    SNAPSHOT.refresh()
+
+
+
+
+async def run_publisher():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        # sólo corre si hay quien lea el almacén (workers o STORE_NAME), y esos lectores no
+        # muestrean: lo que vean de CPU es lo que se muestree aquí
+        CPU_SAMPLER.current()
+        CORE_SAMPLER.current()
+        publish_registry()
+
+
+
+
+async def run_reader():
+    while True:
+        await asyncio.sleep(SNAPSHOT_POLL)
+        refresh_registry()
+
+
+
+
+# --------------------------------------------------------------------
+# MAIN LOOP
+# --------------------------------------------------------------------
+def main():
+    print("Mini SNMP Agent (pysnmp 7.1.4)")
+    workers = WORKERS
+    if workers and not hasattr(socket, "SO_REUSEPORT"):
+        print("[WARN] Sin SO_REUSEPORT en este sistema: se atiende en un solo proceso")
+        workers = 0
+    for listener in LISTENERS:
+        print(f"Escuchando en {listener['name']}: {listener['kind']} {listener['address']} "
+              f"(comunidades: {'/'.join(listener['communities'])})"
+              + (f" con {workers} workers" if workers and listener["kind"] in REUSE_PORT_KINDS else ""))
+
+
+    ACCESS.prepare(REGISTRY)   # antes del fork: los workers heredan las decisiones
+    global STORE
+    if STORE_NAME or workers:
+        STORE = SharedStore.create(REGISTRY, STORE_NAME)
+    # los workers se crean antes que el bucle y los hilos: el fork copia un proceso limpio
+    processes = start_workers(workers) if workers else []
+    loop = asyncio.get_event_loop()
+    if processes:
+        # los puertos UDP son de los workers; aquí los SET reenviados y los sockets Unix
+        open_listeners([kind for kind in TRANSPORT_KINDS if kind not in REUSE_PORT_KINDS])
+        for _, conn in processes:
+            serve_forwarded_sets(loop, conn)
+    else:
+        open_listeners()
+    open_notification_transports()
+    if STORE is not None:
+        loop.create_task(run_publisher())
+    loop.create_task(cpu_monitor())
+    loop.create_task(STATE_WRITER.run())
+    loop.create_task(GOVERNOR.run())
+    loop.create_task(SCHEDULER.run())
+    if ENABLE_EMAIL:
+        loop.create_task(EMAIL.run())
+    try:
+        # SIGTERM también pasa por el finally para volcar el estado pendiente
+        loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    except (NotImplementedError, AttributeError):
+        pass
+
+
+    try:
+        snmp_engine.transportDispatcher.jobStarted(1)
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("Cerrando agente...")
+    finally:
+        if processes:
+            stop_workers(processes)
+        close_listeners()
+        if STORE is not None:
+            STORE.close()
+        STATE_WRITER.flush_now()
+        EMAIL.close()
+        print("Agente cerrado.")
+
+
+
+
+if __name__ == "__main__":
+    main()
+
+
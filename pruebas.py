@@ -18,6 +18,29 @@ init(autoreset=True)
 HOST = "127.0.0.1:1161"
 COMM_RO = "public"
 COMM_RW = "private"
+# usuarios SNMPv3: el mismo fichero que lee el agente (v3_users.json o MINI_AGENT_V3_USERS)
+V3_USERS_FILE = os.environ.get("MINI_AGENT_V3_USERS",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "v3_users.json"))
+V3_AUTH = {"md5": "MD5", "sha": "SHA", "sha256": "SHA-256", "sha512": "SHA-512"}
+V3_PRIV = {"des": "DES", "aes": "AES", "aes256": "AES-256"}
+
+
+def v3_args(access):
+    """Opciones de net-snmp para el primer usuario con ese acceso, o None si no hay."""
+    try:
+        with open(V3_USERS_FILE, encoding="utf-8") as f:
+            users = json.load(f)
+    except FileNotFoundError:
+        return None
+    for u in users:
+        if u["access"] == access:
+            return (f"-v3 -l authPriv -u {u['user']} -a {V3_AUTH[u['auth']]} -A '{u['auth_key']}' "
+                    f"-x {V3_PRIV[u['priv']]} -X '{u['priv_key']}'")
+    return None
+
+
+V3_RO = v3_args("ro")
+V3_RW = v3_args("rw")
 
 BASE_OID = "1.3.6.1.4.1.28308.1"
 OIDS = {
@@ -29,6 +52,10 @@ OIDS = {
 }
 
 STATE_FILE = os.path.join(os.path.dirname(__file__), "mib_state.json")
+# deben coincidir con el agente: STATE_FLUSH_INTERVAL, PERSIST_VOLATILE y los objetos de VOLATILE_OIDS
+STATE_FLUSH_INTERVAL = 2.0
+PERSIST_VOLATILE = False
+VOLATILE = {"cpuUsage"}
 
 summary = []
 
@@ -85,6 +112,8 @@ def snmpget_value(oid, community=COMM_RW):
 
 def check_json_state():
     print(Fore.CYAN + "\n🔹 Comprobando persistencia en mib_state.json usando OID reales...")
+    # la escritura es diferida: esperar un ciclo de volcado para ver los últimos SET
+    time.sleep(STATE_FLUSH_INTERVAL + 0.5)
     if not os.path.exists(STATE_FILE):
         print(Fore.YELLOW + "⚠️ No se encontró mib_state.json, quizá el agente aún no lo ha creado.")
         summary.append(["Persistencia (json)", "Persistencia", "WARN"])
@@ -100,6 +129,17 @@ def check_json_state():
 
     for name, oid in OIDS.items():
         json_entry = data.get(oid)
+
+        if name in VOLATILE and not PERSIST_VOLATILE:
+            # los objetos volátiles no se guardan salvo PERSIST_VOLATILE
+            if json_entry is None:
+                print(Fore.WHITE + f"OID {oid} ({name}) → no persistido (volátil), como se esperaba")
+                summary.append([f"JSON {name}", "Persistencia", "OK"])
+            else:
+                print(Fore.RED + f"❌ El OID volátil {oid} ({name}) aparece en el JSON")
+                summary.append([f"JSON {name}", "Persistencia", "FAIL"])
+            continue
+
         agent_val = snmpget_value(oid, community=COMM_RW)
 
         if json_entry is None:
@@ -205,6 +245,26 @@ def test_access():
         f"snmpwalk -v2c -c {COMM_RO} {HOST} {BASE_OID}"
     )])
 
+    # 9b) SNMPv3 authPriv: el usuario de solo lectura lee, el de escritura escribe
+    if V3_RO:
+        summary.append(["GET cpuThreshold (v3 ro)", "Lectura", run_cmd(
+            "GET cpuThreshold con SNMPv3 authPriv (usuario de solo lectura)",
+            f"snmpget {V3_RO} {HOST} {OIDS['cpuThreshold']}"
+        )])
+
+        summary.append(["SET manager (v3 ro)", "Error notWritable", run_cmd(
+            "SET manager con el usuario SNMPv3 de solo lectura",
+            f"snmpset {V3_RO} {HOST} {OIDS['manager']} s \"NoDeberia\"",
+            expect_error="notWritable"
+        )])
+    if V3_RW:
+        summary.append(["SET manager (v3 rw)", "Escritura", run_cmd(
+            "SET manager con SNMPv3 authPriv (usuario de lectura y escritura)",
+            f"snmpset {V3_RW} {HOST} {OIDS['manager']} s \"CarlayArancha\""
+        )])
+    if not (V3_RO and V3_RW):
+        summary.append(["SNMPv3 authPriv", "Lectura/Escritura", "WARN"])
+
     # 10) Comprobar JSON por OID
     check_json_state()
 
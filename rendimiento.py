@@ -0,0 +1,649 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks de rendimiento del Mini SNMP Agent
+
+Uso: python rendimiento.py [get] [sampler] [trap] [fanout] [window] [rules] [collect] [workers] [store] [transports] [v3] [acl]
+"""
+
+import asyncio
+import multiprocessing
+import json
+import os
+import pickle
+import psutil
+import selectors
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+# el agente crea su fichero de estado en el directorio actual: usamos uno temporal
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, AGENT_DIR)
+os.chdir(tempfile.mkdtemp(prefix="mini_agent_bench_"))
+
+import mini_agent_versionFinal as agent
+from pysnmp.proto.api import v2c
+from pyasn1.codec.ber import encoder
+
+
+BASE_OID = "1.3.6.1.4.1.28308.1"
+SCALARS = [f"{BASE_OID}.{i}.0" for i in range(1, 6)]
+
+
+def report(name, count, elapsed, unit="req/s"):
+    print(f"  {name:<34} {count / elapsed:>12,.0f} {unit}   ({elapsed * 1000:.1f} ms)")
+
+
+# ===== GET (caché de varbinds) =====
+class _BenchGet(agent.MiniGet):
+    """MiniGet sin registrar en el motor: sendPdu sólo descarta la respuesta."""
+
+    def __init__(self):
+        self._view = agent.ACCESS.view(2, b"public-area", 1, b"")
+
+    def sendPdu(self, snmpEngine, stateReference, PDU):
+        pass
+
+
+def make_get_pdu(oids):
+    pdu = v2c.GetRequestPDU()
+    v2c.apiPDU.setDefaults(pdu)
+    v2c.apiPDU.setVarBinds(pdu, [(v2c.ObjectIdentifier(o), v2c.null) for o in oids])
+    return pdu
+
+
+def bench_get(requests=10000):
+    print(f"\nGET de {len(SCALARS)} escalares x {requests} peticiones (handler en proceso)")
+    handler = _BenchGet()
+    pdu = make_get_pdu(SCALARS)
+    for cached in (False, True):
+        agent.CACHE_VARBINDS = cached
+        agent.REGISTRY.invalidate_all()
+        start = time.perf_counter()
+        for _ in range(requests):
+            handler.handleMgmtOperation(None, None, None, pdu)
+        report("con caché" if cached else "sin caché (antes)", requests, time.perf_counter() - start)
+    agent.CACHE_VARBINDS = True
+
+
+# ===== Muestreo bajo demanda (TTL) =====
+def bench_sampler(requests=10000):
+    print(f"\nGET de cpuUsage x {requests} peticiones: muestrear en cada GET frente a caché con TTL")
+    handler = _BenchGet()
+    pdu = make_get_pdu([agent.CPU_OID])
+    sampler = agent.CPU_SAMPLER
+    ttl = sampler.ttl
+    for label, sampler_ttl in (("muestreo en cada GET (antes)", 0.0), (f"TTL {ttl:g} s", ttl)):
+        sampler.ttl = sampler_ttl
+        sampler.refreshes = 0
+        start = time.perf_counter()
+        for _ in range(requests):
+            handler.handleMgmtOperation(None, None, None, pdu)
+        report(label, requests, time.perf_counter() - start)
+        print(f"  {'':<34} {sampler.refreshes:>12,} lecturas de psutil")
+    sampler.ttl = ttl
+
+
+# ===== Traps (en el bucle frente a run_in_executor) =====
+class _TrapSink(asyncio.DatagramProtocol):
+    """Receptor UDP local: cuenta los traps y avisa al llegar al número esperado."""
+
+    def __init__(self):
+        self.count = 0
+        self.expected = 0
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        self.count += 1
+        if self.waiter is not None and self.count >= self.expected and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_for(self, expected, timeout=10):
+        self.expected = expected
+        if self.count < expected:
+            self.waiter = asyncio.get_running_loop().create_future()
+            await asyncio.wait_for(self.waiter, timeout)
+
+
+async def _bench_trap(traps, samples):
+    loop = asyncio.get_running_loop()
+    transport, sink = await loop.create_datagram_endpoint(_TrapSink, local_addr=("127.0.0.1", 0))
+    agent.open_transport(("127.0.0.1", 0))
+    agent.add_notification_target("trap-dest-localhost", ("127.0.0.1", transport.get_extra_info("sockname")[1]))
+    name = "cpuOverThresholdNotification"
+
+
+    async def in_executor():
+        await loop.run_in_executor(None, agent.NTF_ORG.sendVarBinds, agent.snmp_engine, "trap-dest-localhost",
+                                   None, b"", agent.NOTIFICATIONS[name].varbinds())
+
+
+    async def in_executor_burst(n):
+        # de uno en uno: varios hilos a la vez dentro de snmp_engine rompen su estado
+        # interno (KeyError en observer.clearExecutionContext)
+        for _ in range(n):
+            await in_executor()
+
+
+    async def native():
+        agent.send_notification(name, governed=False)
+
+
+    async def native_burst(n, window=64):
+        # el receptor comparte el bucle: como mucho window traps en vuelo para no
+        # desbordar su búfer UDP y medir envíos, no pérdidas
+        base = sink.count
+        for i in range(n):
+            agent.send_notification(name, governed=False)
+            if i % window == window - 1:
+                await sink.wait_for(base + i + 1 - window)
+
+
+    for label, send, burst in (("run_in_executor (antes)", in_executor, in_executor_burst),
+                               ("en el bucle", native, native_burst)):
+        latencies = []
+        for _ in range(samples):
+            expected = sink.count + 1
+            start = time.perf_counter()
+            await send()
+            await sink.wait_for(expected)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f"  {label:<34} latencia mediana {statistics.median(latencies) * 1e6:8.0f} us"
+              f"   p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6:8.0f} us")
+        start = time.perf_counter()
+        target = sink.count + traps
+        await burst(traps)
+        await sink.wait_for(target)
+        report(f"{label}: ráfaga", traps, time.perf_counter() - start, "traps/s")
+    transport.close()
+    agent.snmp_engine.transportDispatcher.closeDispatcher()
+
+
+def bench_trap(traps=2000, samples=500):
+    print(f"\nTrap cpuOverThresholdNotification a un receptor UDP local ({samples} de uno en uno, ráfaga de {traps})")
+    asyncio.run(_bench_trap(traps, samples))
+
+
+# ===== Reparto a N destinos =====
+async def _bench_fanout(sizes, rounds):
+    loop = asyncio.get_running_loop()
+    agent.open_transport(("127.0.0.1", 0))
+    name = "cpuOverThresholdNotification"
+    for n in sizes:
+        tag = f"bench-{n}"
+        sinks = []
+        for i in range(n):
+            transport, sink = await loop.create_datagram_endpoint(_TrapSink, local_addr=("127.0.0.1", 0))
+            sinks.append((transport, sink))
+            agent.add_notification_target(f"{tag}-{i}", ("127.0.0.1", transport.get_extra_info("sockname")[1]),
+                                          tags=(tag,))
+        latencies = []
+        for r in range(1, rounds + 1):
+            start = time.perf_counter()
+            agent.send_notification(name, tag, governed=False)
+            for _, sink in sinks:
+                await sink.wait_for(r)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f"  {n:>4} destinos   mediana {statistics.median(latencies) * 1000:8.2f} ms"
+              f"   p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:8.2f} ms"
+              f"   ({statistics.median(latencies) * 1e6 / n:.0f} us por destino)")
+        for transport, _ in sinks:
+            transport.close()
+    agent.snmp_engine.transportDispatcher.closeDispatcher()
+
+
+def bench_fanout(sizes=(1, 10, 100), rounds=50):
+    print(f"\nReparto de una notificación a N receptores UDP locales (hasta que llega a todos, {rounds} rondas)")
+    asyncio.run(_bench_fanout(sizes, rounds))
+
+
+# ===== Agregados en ventana deslizante =====
+class _NaiveWindow:
+    """Recalcula media, mínimo, máximo y percentil sobre toda la ventana en cada muestra."""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+
+
+    def add(self, value):
+        self.samples.append(value)
+        ordered = sorted(self.samples)
+        return (sum(ordered) / len(ordered), ordered[0], ordered[-1],
+                ordered[max(0, -(-95 * len(ordered) // 100) - 1)])
+
+
+
+
+def bench_window(samples=20000, sizes=(12, 60, 180, 720, 3600)):
+    print(f"\nAgregados (media, mín, máx, p95) por muestra, {samples} muestras, según el tamaño de ventana")
+    values = [(i * 37) % 101 for i in range(samples)]
+    for size in sizes:
+        for label, window in (("recalculando la ventana (antes)", _NaiveWindow(size)),
+                              ("incremental", agent.SlidingWindow(size))):
+            add = window.add
+            start = time.perf_counter()
+            if isinstance(window, agent.SlidingWindow):
+                for v in values:
+                    add(v)
+                    window.avg(), window.min(), window.max(), window.percentile(95)
+            else:
+                for v in values:
+                    add(v)
+            elapsed = time.perf_counter() - start
+            print(f"  {size:>5} muestras  {label:<32} {elapsed * 1e6 / samples:8.2f} us/muestra")
+
+
+# ===== Motor de reglas =====
+def bench_rules(samples=2000, sizes=(10, 100, 1000)):
+    print(f"\nUna muestra de cpuUsage frente a N reglas repartidas entre los escalares enteros ({samples} muestras)")
+    table = agent.RULES.table
+    names = [name for name, obj in agent.REGISTRY.by_name.items()
+             if issubclass(obj._asn1, agent.univ.Integer)]
+    for n in sizes:
+        table.clear()
+        for i in range(1, n + 1):
+            # umbral inalcanzable: se mide la evaluación, no el envío de traps
+            table.add_row((i,), ruleObject=names[i % len(names)], ruleThreshold=10 ** 9,
+                          ruleStatus=agent.ACTIVE)
+        agent.RULES.compile()
+        rules = list(agent.RULES.rules.values())
+        check = agent.RULES.check
+
+
+        def scan(name, value):
+            for rule in rules:
+                if rule.object == name:
+                    check(rule, value)
+
+
+        for label, feed in (("recorriendo todas (antes)", scan), ("índice por objeto", agent.RULES.feed)):
+            start = time.perf_counter()
+            for v in range(samples):
+                feed("cpuUsage", v)
+            elapsed = time.perf_counter() - start
+            print(f"  {n:>5} reglas  {label:<32} {elapsed * 1e6 / samples:8.2f} us/muestra")
+    table.clear()
+    agent.RULES.compile()
+
+
+
+
+# ===== Recolectores: un salto de hilo por métrica frente al planificador =====
+async def _bench_collect(ticks):
+    loop = asyncio.get_running_loop()
+    scheduler = agent.SCHEDULER
+    interval = min(scheduler.groups)
+    collectors = scheduler.groups[interval]
+
+
+    async def per_metric():
+        # como copiar cpu_monitor: cada métrica con su llamada al executor y sus update()
+        for collector in collectors:
+            raw = await loop.run_in_executor(None, collector.collect)
+            for name, value in collector.publish(raw, interval).items():
+                agent.REGISTRY.update(name, value)
+
+
+    async def batched():
+        results = await loop.run_in_executor(None, scheduler._collect, collectors)
+        scheduler.publish(interval, results, time.monotonic())
+
+
+    for label, tick in (("una tarea por métrica (antes)", per_metric), ("planificador en lote", batched)):
+        start = time.perf_counter()
+        for _ in range(ticks):
+            await tick()
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<34} {elapsed * 1e6 / ticks:8.0f} us/tick")
+
+
+def bench_collect(ticks=500):
+    names = ", ".join(c.name for c in agent.SCHEDULER.groups[min(agent.SCHEDULER.groups)])
+    print(f"\nUn tick de los recolectores de {min(agent.SCHEDULER.groups):g} s ({names}), {ticks} ticks")
+    asyncio.run(_bench_collect(ticks))
+
+
+
+
+# ===== Carga contra el agente real: un proceso frente a N workers =====
+AGENT_SCRIPT = """
+import sys
+sys.path.insert(0, {dir!r})
+import mini_agent_versionFinal as agent
+agent.ENABLE_EMAIL = False
+agent.LISTENERS = {listeners!r}
+agent.WORKERS = {workers}
+agent.main()
+"""
+
+
+def bench_listeners(port, unix_path=None):
+    """Listeners del agente de los benchmarks: UDP en localhost y, si se pide, IPv6 y Unix."""
+    communities = {"public": "public-area", "private": "private-area"}
+    listeners = [{"name": "ipv4", "kind": "udp", "address": ("127.0.0.1", port), "communities": communities}]
+    if unix_path:
+        listeners += [{"name": "ipv6", "kind": "udp6", "address": ("::1", port), "communities": communities},
+                      {"name": "local", "kind": "unix", "address": unix_path, "communities": communities}]
+    return listeners
+
+
+def make_get_message(oids, request_id, community=b"public"):
+    pdu = make_get_pdu(oids)
+    v2c.apiPDU.setRequestID(pdu, request_id)
+    msg = v2c.Message()
+    v2c.apiMessage.setDefaults(msg)
+    v2c.apiMessage.setCommunity(msg, community)
+    v2c.apiMessage.setPDU(msg, pdu)
+    return encoder.encode(msg)
+
+
+def _load_client(port, sockets, duration, results):
+    """Cliente en bucle cerrado: sockets peticiones en vuelo, una por socket (puertos distintos)."""
+    sel = selectors.DefaultSelector()
+    for i in range(sockets):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(("127.0.0.1", port))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, make_get_message(SCALARS, i + 1))
+    count = 0
+    end = time.perf_counter() + duration
+    for key in sel.get_map().values():
+        key.fileobj.send(key.data)
+    while time.perf_counter() < end:
+        events = sel.select(0.5)
+        if not events:
+            # alguna respuesta perdida: se vuelve a pedir para no quedarse sin peticiones en vuelo
+            for key in sel.get_map().values():
+                key.fileobj.send(key.data)
+        for key, _ in events:
+            try:
+                key.fileobj.recv(65535)
+            except BlockingIOError:
+                continue
+            count += 1
+            key.fileobj.send(key.data)
+    results.put(count)
+
+
+def _wait_agent(port, timeout=15):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.3)
+    message = make_get_message(SCALARS[:1], 1)
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        s.sendto(message, ("127.0.0.1", port))
+        try:
+            s.recv(65535)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def bench_workers(counts=(0, 1, 2, 4), clients=4, sockets=8, duration=3.0, port=11161):
+    print(f"\nGET de {len(SCALARS)} escalares contra el agente en UDP/{port}: {clients} clientes x {sockets} "
+          f"peticiones en vuelo, {duration:g} s ({os.cpu_count()} CPU)")
+    ctx = multiprocessing.get_context("fork")
+    for workers in counts:
+        agent_proc = subprocess.Popen([sys.executable, "-c", AGENT_SCRIPT.format(dir=AGENT_DIR, listeners=bench_listeners(port), workers=workers)],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _wait_agent(port):
+                print(f"  {workers} workers: el agente no responde")
+                continue
+            results = ctx.Queue()
+            procs = [ctx.Process(target=_load_client, args=(port, sockets, duration, results))
+                     for _ in range(clients)]
+            for p in procs:
+                p.start()
+            total = sum(results.get() for _ in procs)
+            for p in procs:
+                p.join()
+            label = f"{workers} workers" if workers else "un proceso (antes)"
+            report(label, total, duration)
+        finally:
+            agent_proc.send_signal(signal.SIGTERM)
+            agent_proc.wait(10)
+
+
+
+
+# ===== Latencia por transporte: UDP/IPv4, UDP/IPv6 y socket Unix =====
+def _round_trips(family, address, requests):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    client_path = None
+    if family == socket.AF_UNIX:
+        # un socket Unix de datagramas sólo recibe la respuesta si tiene dirección propia
+        client_path = os.path.abspath(f"client-{os.getpid()}.sock")
+        sock.bind(client_path)
+    sock.settimeout(2)
+    sock.connect(address)
+    message = make_get_message(SCALARS[:1], 1)
+    samples = []
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            sock.send(message)
+            sock.recv(65535)
+            samples.append(time.perf_counter() - start)
+    finally:
+        sock.close()
+        if client_path:
+            os.unlink(client_path)
+    return samples
+
+
+def bench_transports(requests=3000, port=11161):
+    unix_path = os.path.abspath("agent.sock")
+    print(f"\nLatencia de un GET de 1 escalar, petición a petición ({requests} por transporte)")
+    agent_proc = subprocess.Popen([sys.executable, "-c", AGENT_SCRIPT.format(
+                                      dir=AGENT_DIR, listeners=bench_listeners(port, unix_path), workers=0)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not _wait_agent(port):
+            print("  el agente no responde")
+            return
+        for label, family, address in (("UDP/IPv4 (127.0.0.1)", socket.AF_INET, ("127.0.0.1", port)),
+                                       ("UDP/IPv6 (::1)", socket.AF_INET6, ("::1", port)),
+                                       ("socket Unix", socket.AF_UNIX, unix_path)):
+            try:
+                _round_trips(family, address, 200)   # calentamiento
+                samples = sorted(_round_trips(family, address, requests))
+            except OSError as exc:
+                print(f"  {label:<34} no disponible ({exc})")
+                continue
+            print(f"  {label:<34} media {statistics.mean(samples) * 1e6:7.0f} us   "
+                  f"p50 {samples[len(samples) // 2] * 1e6:7.0f} us   p99 {samples[int(len(samples) * 0.99)] * 1e6:7.0f} us")
+    finally:
+        agent_proc.send_signal(signal.SIGTERM)
+        agent_proc.wait(10)
+
+
+
+
+# ===== SNMPv3 authPriv frente a v2c =====
+async def _hlapi_gets(port, auth, requests, concurrency):
+    from pysnmp.hlapi.v3arch.asyncio import (ContextData, ObjectIdentity, ObjectType, SnmpEngine,
+                                             UdpTransportTarget, getCmd)
+    engine = SnmpEngine()
+    target = await UdpTransportTarget.create(("127.0.0.1", port), timeout=2, retries=1)
+    names = [ObjectType(ObjectIdentity(oid)) for oid in SCALARS]
+    errors = 0
+
+
+    async def client(count):
+        nonlocal errors
+        for _ in range(count):
+            error_indication, error_status, _, _ = await getCmd(engine, auth, target, ContextData(), *names)
+            errors += bool(error_indication or error_status)
+
+
+    await asyncio.gather(*(client(requests // concurrency) for _ in range(concurrency)))
+    engine.closeDispatcher()
+    return errors
+
+
+def bench_v3(requests=1000, concurrency=4, port=11161):
+    import warnings
+    from pysnmp.hlapi.v3arch.asyncio import (CommunityData, UsmUserData, usmAesCfb128Protocol,
+                                             usmHMACSHAAuthProtocol)
+    warnings.simplefilter("ignore")   # aviso de cryptography sobre el modo CFB que usa pysnmp
+    # usuario propio del benchmark, en un fichero temporal: no depende de v3_users.json
+    user = {"user": "bench", "auth": "sha", "auth_key": os.urandom(8).hex(), "priv": "aes",
+            "priv_key": os.urandom(8).hex(), "access": "ro"}
+    users_file = os.path.abspath("v3_users_bench.json")
+    with open(os.open(users_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump([user], f)
+    print(f"\nGET de {len(SCALARS)} escalares con el cliente de pysnmp, {concurrency} en vuelo, "
+          f"{requests} peticiones ({os.cpu_count()} CPU)")
+    agent_proc = subprocess.Popen([sys.executable, "-c", AGENT_SCRIPT.format(
+                                      dir=AGENT_DIR, listeners=bench_listeners(port), workers=0)],
+                                  env=dict(os.environ, MINI_AGENT_V3_USERS=users_file),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not _wait_agent(port):
+            print("  el agente no responde")
+            return
+        agent_cpu = psutil.Process(agent_proc.pid)
+        for label, auth in (("v2c (public)", CommunityData("public")),
+                            (f"v3 authPriv ({user['user']}, SHA/AES)",
+                             UsmUserData(user["user"], user["auth_key"], user["priv_key"],
+                                         authProtocol=usmHMACSHAAuthProtocol, privProtocol=usmAesCfb128Protocol))):
+            asyncio.run(_hlapi_gets(port, auth, 40, concurrency))   # calentamiento (y descubrimiento del motor)
+            before = sum(agent_cpu.cpu_times()[:2])
+            start = time.perf_counter()
+            errors = asyncio.run(_hlapi_gets(port, auth, requests, concurrency))
+            elapsed = time.perf_counter() - start
+            cpu = sum(agent_cpu.cpu_times()[:2]) - before
+            report(label, requests, elapsed)
+            print(f"  {'':<34} {cpu * 1e6 / requests:12,.0f} us de CPU del agente por petición"
+                  + (f"   ({errors} errores)" if errors else ""))
+    finally:
+        agent_proc.send_signal(signal.SIGTERM)
+        agent_proc.wait(10)
+
+
+
+
+# ===== Lectura de los escalares desde otro proceso =====
+def bench_store(rounds=2000):
+    names = list(agent.REGISTRY.by_name)
+    print(f"\nLectura de los {len(names)} escalares por un lector externo ({rounds} veces) y escritura por tick")
+    agent.save_state({obj.oid: (obj.syntax, obj.value) for obj in agent.REGISTRY.objects.values()})
+    store = agent.SharedStore.create(agent.REGISTRY)
+    reader = agent.SharedStore.attach(store.name)
+    blob = pickle.dumps({name: obj.value for name, obj in agent.REGISTRY.by_name.items()})
+    try:
+        def from_json():
+            with open(agent.STATE_FILE) as f:
+                return json.load(f)
+
+
+        for label, read in (("releyendo mib_state.json (antes)", from_json),
+                            ("copia serializada (pickle)", lambda: pickle.loads(blob)),
+                            ("almacén compartido: todos", reader.snapshot),
+                            ("almacén compartido: cpuUsage", lambda: reader.read("cpuUsage"))):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                read()
+            report(label, rounds, time.perf_counter() - start, "lecturas/s")
+
+
+        # escritor: un tick típico cambia unos pocos escalares
+        start = time.perf_counter()
+        for i in range(rounds):
+            agent.REGISTRY.by_name["cpuUsage"].value = i % 100
+            agent.REGISTRY.by_name["memAvailable"].value = i
+            store.publish()
+        report("publish() con 2 cambios por tick", rounds, time.perf_counter() - start, "ticks/s")
+        start = time.perf_counter()
+        for _ in range(rounds):
+            pickle.dumps({name: obj.value for name, obj in agent.REGISTRY.by_name.items()})
+        report("serializar todo en cada tick", rounds, time.perf_counter() - start, "ticks/s")
+    finally:
+        reader.close()
+        store.close()
+
+
+
+
+# ===== Control de acceso por varbind =====
+def bench_acl(requests=10000):
+    print(f"\nAutorización de un SET de {len(SCALARS)} escalares x {requests} mensajes")
+    engine = agent.snmp_engine
+    oids = [v2c.ObjectIdentifier(o) for o in SCALARS]
+    name = v2c.OctetString("private-area")
+    vacm = engine.accessControlModel[3]
+
+
+    def observer_lookup():
+        # antes: securityName sacado del contexto del observer en cada SET, sin mirar el OID
+        ctx = engine.observer.getExecutionContext("rfc3412.receiveMessage:request")
+        return agent.SECURITY_NAMES.get(ctx.get("securityName").prettyPrint()) == "ro"
+
+
+    def vacm_per_varbind():
+        return all(vacm.isAccessAllowed(engine, 2, name, 1, "write", v2c.OctetString(""), oid) is None
+                   for oid in oids)
+
+
+    def access_view():
+        view = agent.ACCESS.view(2, b"private-area", 1, b"")
+        return all(view.writable(agent.REGISTRY.access_key(oid)) for oid in oids)
+
+
+    engine.observer.storeExecutionContext(engine, "rfc3412.receiveMessage:request", {"securityName": name})
+    try:
+        agent.ACCESS.prepare(agent.REGISTRY)
+        for label, check in (("observer + prettyPrint (antes)", observer_lookup),
+                             ("VACM por varbind, sin tabla", vacm_per_varbind),
+                             ("vista precalculada por varbind", access_view)):
+            start = time.perf_counter()
+            for _ in range(requests):
+                check()
+            report(label, requests, time.perf_counter() - start, "msg/s")
+    finally:
+        engine.observer.clearExecutionContext(engine, "rfc3412.receiveMessage:request")
+
+
+    print(f"GET de {len(SCALARS)} escalares x {requests} peticiones, con y sin comprobar la vista de lectura")
+    handler = _BenchGet()
+    pdu = make_get_pdu(SCALARS)
+    for label, view in (("sin vista", None), ("con vista de public-area", handler._view)):
+        handler._view = view
+        start = time.perf_counter()
+        for _ in range(requests):
+            handler.handleMgmtOperation(None, None, None, pdu)
+        report(label, requests, time.perf_counter() - start)
+
+
+
+
+BENCHMARKS = {
+    "get": bench_get,
+    "sampler": bench_sampler,
+    "trap": bench_trap,
+    "fanout": bench_fanout,
+    "window": bench_window,
+    "rules": bench_rules,
+    "collect": bench_collect,
+    "workers": bench_workers,
+    "store": bench_store,
+    "transports": bench_transports,
+    "v3": bench_v3,
+    "acl": bench_acl,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()